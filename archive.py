@@ -0,0 +1,204 @@
+"""
+archive.py - compressed, indexed archive of the raw report and search html
+
+The pages are appended as independently compressed frames (zstd if the
+zstandard package is installed, zlib otherwise) to a single pack file with
+a sqlite index next to it (pack file + ".idx") of the offset and length of
+every key, so single pages can be read directly and all pages scanned
+sequentially. Reports are keyed by report id ("2418") and searches by map
+location, programme and page ("bp/TKDAT/0").
+"""
+import os
+import zlib
+import hashlib
+import sqlite3
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+_SCHEMA = "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, offset INTEGER, length INTEGER, size INTEGER, codec TEXT, hash TEXT)"
+
+def search_location(search_path: str):
+    """
+        Returns the map location of the search directory, the first part of
+        the archive keys of its searches ("./data/bp/search" -> "bp").
+    """
+    return os.path.basename(os.path.dirname(os.path.normpath(search_path)))
+
+def _compress(data: bytes, codec: str, level: int):
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    return zlib.compress(data, level)
+
+def _decompress(data: bytes, codec: str):
+    if codec == "zstd":
+        if zstandard is None:
+            raise ImportError("The archive has zstd frames, install zstandard to read them")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+class Archive:
+    def __init__(self, path: str, level: int = 6):
+        """
+            Opens (or creates) the archive at path. New pages are compressed
+            with zstd when available at the given level.
+        """
+        self.path = path
+        self.level = level
+        self.codec = "zstd" if zstandard is not None else "zlib"
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._recover()
+        open(path, 'ab').close()
+        self.con = sqlite3.connect(path + ".idx", check_same_thread=False)
+        self.con.execute(_SCHEMA)
+        self.con.commit()
+        self._lock = threading.Lock()
+        self._file = open(path, 'r+b')
+
+    def _recover(self):
+        """
+            Finishes or drops a compaction that was interrupted. The new
+            index is only created once the new pack is complete, so a new
+            index without a new pack means the pack was swapped and only
+            the index is missing. Before that the old pack and index are
+            still whole.
+        """
+        if os.path.exists(self.path + ".idx.tmp") and not os.path.exists(self.path + ".tmp"):
+            os.replace(self.path + ".idx.tmp", self.path + ".idx")
+        for tmp in (self.path + ".tmp", self.path + ".idx.tmp", self.path + ".idx.tmp-journal"):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def __contains__(self, key: str):
+        with self._lock:
+            return self.con.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone() is not None
+
+    def __len__(self):
+        with self._lock:
+            return self.con.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def put(self, key: str, text: str):
+        """
+            Appends the page to the archive, replacing the page stored under
+            the key if any (the old frame stays in the pack until compact).
+        """
+        data = text.encode("utf-8")
+        frame = _compress(data, self.codec, self.level)
+        with self._lock:
+            self._file.seek(0, os.SEEK_END)
+            offset = self._file.tell()
+            self._file.write(frame)
+            self._file.flush()
+            # the index is only updated once the frame is written, a crash leaves an unreferenced frame
+            self.con.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                             (key, offset, len(frame), len(data), self.codec, hashlib.sha1(data).hexdigest()))
+            self.con.commit()
+
+    def _read(self, offset: int, length: int, codec: str):
+        with self._lock:
+            self._file.seek(offset)
+            frame = self._file.read(length)
+        return _decompress(frame, codec).decode("utf-8")
+
+    def get(self, key: str):
+        """
+            Returns the page stored under the key or None.
+        """
+        with self._lock:
+            row = self.con.execute("SELECT offset, length, codec FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return self._read(*row)
+
+    def hash(self, key: str):
+        """
+            Returns the sha1 of the page stored under the key.
+        """
+        with self._lock:
+            row = self.con.execute("SELECT hash FROM entries WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def keys(self, prefix: str = ""):
+        """
+            Returns the keys starting with prefix in the order they are
+            stored in the pack.
+        """
+        with self._lock:
+            rows = self.con.execute("SELECT key FROM entries WHERE substr(key, 1, ?) = ? ORDER BY offset", (len(prefix), prefix)).fetchall()
+        return [row[0] for row in rows]
+
+    def items(self, prefix: str = ""):
+        """
+            Yields the key and page of every key starting with prefix,
+            reading the pack sequentially.
+        """
+        with self._lock:
+            rows = self.con.execute("SELECT key, offset, length, codec FROM entries WHERE substr(key, 1, ?) = ? ORDER BY offset",
+                                    (len(prefix), prefix)).fetchall()
+        for key, offset, length, codec in rows:
+            yield key, self._read(offset, length, codec)
+
+    def compact(self):
+        """
+            Rewrites the pack without the frames of replaced pages. The new
+            pack and its index are written next to the old ones and swapped
+            in last, an interrupted compaction is finished or dropped when
+            the archive is opened again.
+        """
+        with self._lock:
+            rows = self.con.execute("SELECT key, offset, length, size, codec, hash FROM entries ORDER BY offset").fetchall()
+            entries = []
+            with open(self.path + ".tmp", 'wb') as out:
+                for key, offset, length, size, codec, hash in rows:
+                    self._file.seek(offset)
+                    entries.append((key, out.tell(), length, size, codec, hash))
+                    out.write(self._file.read(length))
+                out.flush()
+                os.fsync(out.fileno())
+            # the new index is only created once the new pack is complete, see _recover()
+            index = sqlite3.connect(self.path + ".idx.tmp")
+            index.execute(_SCHEMA)
+            index.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?)", entries)
+            index.commit()
+            index.close()
+            self._file.close()
+            self.con.close()
+            # the pack is swapped first, _recover() finishes the swap of the index after a crash in between
+            os.replace(self.path + ".tmp", self.path)
+            os.replace(self.path + ".idx.tmp", self.path + ".idx")
+            self.con = sqlite3.connect(self.path + ".idx", check_same_thread=False)
+            self._file = open(self.path, 'r+b')
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+            self.con.close()
+
+def pack_reports(reports_path: str, archive: Archive, encoding: str = "utf-8"):
+    """
+        Adds the {report_id}.html files in reports_path to the archive.
+    """
+    for entry in os.scandir(reports_path):
+        if entry.name.endswith(".html"):
+            with open(entry.path, 'r', encoding=encoding) as f:
+                archive.put(entry.name[:-len(".html")], f.read())
+
+def pack_searches(search_path: str, archive: Archive, encoding: str = None):
+    """
+        Adds the <programme>/<n>.html search pages in search_path to the
+        archive under <map location>/<programme>/<n>. The saved searches
+        use the default encoding of the system that fetched them.
+    """
+    location = search_location(search_path)
+    for programme in sorted(os.listdir(search_path)):
+        directory = os.path.join(search_path, programme)
+        if not os.path.isdir(directory):
+            continue
+        for f in sorted(os.listdir(directory)):
+            if f.endswith(".html"):
+                with open(os.path.join(directory, f), 'r', encoding=encoding) as html:
+                    archive.put(f"{location}/{programme}/{f[:-len('.html')]}", html.read())
@@ -0,0 +1,486 @@
+"""
+benchmark.py - benchmarks of the parsing on synthetic reports and the data folder
+
+Runs fully offline on the search pages in data/, search forms rebuilt from
+the *_map.csv files and synthetic reports.
+
+    python benchmark.py suite --reports 1000 --output run.json
+    python benchmark.py compare old.json run.json
+    python benchmark.py scaling
+    python benchmark.py backends
+    python benchmark.py service --requests 5000 --concurrency 50
+    python benchmark.py fetcher --reports 200 --rate-limit 50
+    python benchmark.py course_text
+"""
+import io
+import os
+import sys
+import glob
+import json
+import time
+import random
+import asyncio
+import threading
+import argparse
+import platform
+import tempfile
+import contextlib
+import tracemalloc
+import hashlib
+import urllib.request
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+import pandas as pd
+
+import parser as p
+import str_utils
+import scraper as s
+from store import ResponseStore
+from html_backend import BACKENDS, get_backend
+from service import QueryService
+
+def synthetic_report(report_id: int, questions: int = 20):
+    """
+        Returns the html of a synthetic report following the structure of
+        the course-eval reports (artBaseTable divs with srtbl-* tables) with
+        the given number of mean/median questions.
+    """
+    lp = f"LP{report_id % 4 + 1}"
+    year = 2013 + report_id % 9
+    html = [
+        "<html><body>",
+        f"<h1> SYN{report_id % 1000:03d} Syntetisk kurs {report_id} {year}/{year+1} {lp}-{lp} </h1>",
+        f"<p>{40 + report_id % 60} respondenter, {10 + report_id % 30} svar</p>",
+        "<div class='artBaseTable'><h3>Om enkäten</h3></div>",
+    ]
+    categories = ["1. Kursens mål", "2. Undervisning", "3. Examination", "4. Sammanfattande intryck"]
+    per_category = -(-questions // len(categories)) # ceil
+    for i, category in enumerate(categories):
+        html.append(f"<div class='artBaseTable'><h3>{category}</h3>")
+        for j in range(min(per_category, questions - i * per_category)):
+            html.append(
+                "<table><tr class='srtbl-h1'><th>\xa0</th><th>Medelvärde</th><th>Median</th></tr>"
+                f"<tr><th class='srtbl-rh'> Fråga {i}.{j} </th>"
+                f"<td class='srtbl-cell'>{(report_id + j) % 5 + 1}.{j % 10}</td>"
+                f"<td class='srtbl-cell'>{(report_id * j) % 5 + 1}</td></tr></table>"
+            )
+        html.append("</div>")
+    html.append("</body></html>")
+    return "".join(html)
+
+def write_reports(location: str, rows: int, questions: int = 20):
+    """
+        Writes enough synthetic reports to the location to give the given
+        number of question rows when parsed.
+    """
+    os.makedirs(location, exist_ok=True)
+    for i in range(-(-rows // questions)):
+        with open(os.path.join(location, f"{i}.html"), 'w') as f:
+            f.write(synthetic_report(i, min(questions, rows - i * questions)))
+
+def bench_scaling(sizes: list = [1000, 10000, 100000], workers: int = 1):
+    """
+        Times parse_reports on synthetic report sets of the given number of
+        rows. The time per row should stay flat if the scaling is linear.
+    """
+    results = []
+    for rows in sizes:
+        with tempfile.TemporaryDirectory() as location:
+            write_reports(location, rows)
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                reports = p.parse_reports(location, workers=workers)
+            elapsed = time.perf_counter() - start
+        assert len(reports) == rows
+        results.append((rows, elapsed))
+        print(f"{rows:>8} rows: {elapsed:8.2f}s {rows / elapsed:10.0f} rows/s {elapsed / rows * 1e6:8.1f} us/row")
+    return results
+
+def read_searches(pattern: str = "./data/*/search/*/*.html"):
+    """
+        Returns the html of the search pages in the data folder, they are
+        saved in windows-1252.
+    """
+    searches = []
+    for filename in sorted(glob.glob(pattern)):
+        with open(filename, 'r', encoding="cp1252") as f:
+            searches.append(f.read())
+    return searches
+
+def bench_backends(backends: list = None, reports: int = 500):
+    """
+        Prints the documents per second of every html backend parsing the
+        search pages in the data folder and synthetic reports. Backends
+        whose library is not installed are skipped.
+    """
+    searches = read_searches()
+    report_htmls = [synthetic_report(i) for i in range(reports)]
+    results = {}
+    for name in backends or BACKENDS:
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                for html in searches:
+                    p.parse_search_html("BENCH", html, name)
+                search_time = time.perf_counter() - start
+                start = time.perf_counter()
+                for i, html in enumerate(report_htmls):
+                    p.parse_report(i, html, name)
+                report_time = time.perf_counter() - start
+        except ImportError as e:
+            print(f"{name:>12}: skipped ({e})")
+            continue
+        results[name] = {"search_docs_per_s": len(searches) / search_time, "report_docs_per_s": len(report_htmls) / report_time}
+        print(f"{name:>12}: {len(searches) / search_time:8.1f} searches/s {len(report_htmls) / report_time:8.1f} reports/s")
+    return results
+
+def bench_course_text(sizes: list = [1000, 10000, 100000]):
+    """
+        Prints the course texts per second of the per row parse_course_text
+        and the bulk parse_course_texts on columns of the given sizes made
+        of the course texts of the search pages in the data folder.
+    """
+    texts = [name for html in read_searches() for name, _ in get_backend("bs4").search_rows(html)]
+    results = []
+    for size in sizes:
+        column = pd.Series((texts * (size // len(texts) + 1))[:size], dtype=object)
+        start = time.perf_counter()
+        [str_utils.parse_course_text(text) for text in column]
+        per_row = time.perf_counter() - start
+        start = time.perf_counter()
+        parsed = str_utils.parse_course_texts(column)
+        bulk = time.perf_counter() - start
+        results.append({"size": size, "per_row_per_s": size / per_row, "bulk_per_s": size / bulk, "failed": int((~parsed['parsed']).sum())})
+        print(f"{size:>8} texts: per row {size / per_row:10.0f}/s bulk {size / bulk:10.0f}/s ({per_row / bulk:5.2f}x) "
+              f"{results[-1]['failed']} not parsed")
+    return results
+
+def synthetic_form(map_location: str):
+    """
+        Returns the html of a search form rebuilt from the Programme, Year
+        and LP maps at the location, with the treeCategories1/2/3 trees
+        that Mapper.parse reads.
+    """
+    html = ["<html><body>"]
+    for i, category in enumerate(["Programme", "Year", "LP"]):
+        field = pd.read_csv(os.path.join(map_location, f"{category}_map.csv"), sep=";", keep_default_na=False)
+        html.append(f"<div id='treeCategories{i+1}'><ul><li>Markera alla</li>")
+        for tag, name, sid in field[['tag', 'name', 'sid']].itertuples(index=False):
+            text = f"{tag} - {name}" if name else tag
+            html.append(f"<li><input type='checkbox' tag='{sid}'/>{text}</li>")
+        html.append("</ul></div>")
+    html.append("</body></html>")
+    return "".join(html)
+
+def run_stage(func, docs: list):
+    """
+        Runs func on every doc and returns the throughput, the p50/p99 
+        latency per doc and the peak memory allocated. The memory is
+        measured in a second pass since tracemalloc slows down the run.
+    """
+    latencies = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        for doc in docs:
+            doc_start = time.perf_counter()
+            func(doc)
+            latencies.append(time.perf_counter() - doc_start)
+        elapsed = time.perf_counter() - start
+
+        tracemalloc.start()
+        for doc in docs:
+            func(doc)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    latencies = np.array(latencies) * 1000
+    return {
+        "docs": len(docs),
+        "seconds": elapsed,
+        "docs_per_s": len(docs) / elapsed,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "peak_mb": peak / 1e6,
+    }
+
+def bench_suite(reports: int = 1000, questions: int = 20, backend: str = "bs4", output: str = None):
+    """
+        Benchmarks parse_search on the search pages in data/, parse_report
+        on the given number of synthetic reports, Mapper.parse on the forms
+        rebuilt from the maps and parse_course_text (per row) and
+        parse_course_texts (1000 per doc) on the course names of the
+        search pages. Saves the results as json to output if given.
+    """
+    searches = read_searches()
+    report_htmls = [synthetic_report(i, questions) for i in range(reports)]
+    forms = [synthetic_form("./data/bp"), synthetic_form("./data/mp")]
+    course_texts = [name for html in searches for name, _ in get_backend("bs4").search_rows(html)]
+
+    stages = {
+        # Mapper.parse is parse_form_html
+        "parse_search": (lambda html: p.parse_search_html("BENCH", html, backend), searches),
+        "parse_report": (lambda html: p.parse_report(0, html, backend), report_htmls),
+        "mapper_parse": (lambda html: p.parse_form_html(html, backend), forms),
+        "parse_course_text": (str_utils.parse_course_text, course_texts),
+        "parse_course_texts": (str_utils.parse_course_texts, [course_texts[i:i+1000] for i in range(0, len(course_texts), 1000)]),
+    }
+    results = {
+        "meta": {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "backend": backend,
+            "reports": reports,
+            "questions": questions,
+        },
+        "stages": {},
+    }
+    for name, (func, docs) in stages.items():
+        stage = run_stage(func, docs)
+        results["stages"][name] = stage
+        print(f"{name:>18}: {stage['docs']:7} docs {stage['docs_per_s']:10.1f} docs/s "
+              f"p50 {stage['p50_ms']:8.3f}ms p99 {stage['p99_ms']:8.3f}ms peak {stage['peak_mb']:7.1f}MB")
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved results to {output}")
+    return results
+
+async def _load(port: int, paths: list, requests: int, concurrency: int):
+    """
+        Sends the requests over concurrency keep-alive connections and
+        returns the latency of every request and the failed requests.
+    """
+    latencies, failed = [], []
+    remaining = iter(range(requests))
+
+    async def client():
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        try:
+            for i in remaining:
+                path = paths[i % len(paths)]
+                start = time.perf_counter()
+                writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+                await writer.drain()
+                status = int((await reader.readline()).split()[1])
+                length = 0
+                while (line := await reader.readline()) != b"\r\n":
+                    if line.lower().startswith(b"content-length:"):
+                        length = int(line.split(b":")[1])
+                await reader.readexactly(length)
+                latencies.append(time.perf_counter() - start)
+                if status != 200:
+                    failed.append((path, status))
+        finally:
+            writer.close()
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return latencies, failed
+
+def _get(port: int, path: str):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}{path}") as response:
+        return json.load(response)
+
+def bench_service(reports: int = 1000, requests: int = 5000, concurrency: int = 50, cache_size: int = 4096):
+    """
+        Load tests the query service on synthetic reports: starts it on a
+        free local port, sends a mix of course lookups, prefix searches and
+        rankings over concurrency connections and prints the requests per
+        second, the p50/p99 latency and the cache hit rate. Then saves a
+        larger parse and checks that the service reloads it.
+    """
+    with tempfile.TemporaryDirectory() as location:
+        report_location = os.path.join(location, "reports")
+        write_reports(report_location, reports * 20)
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            parsed = p.parse_reports(report_location)
+        reports_path = os.path.join(location, "report.csv")
+        parsed.to_csv(reports_path, index=False, sep=";")
+
+        service = QueryService(reports_path, [], port=0, cache_size=cache_size, reload_interval=0.2)
+        threading.Thread(target=asyncio.run, args=(service.serve(),), daemon=True).start()
+        service.ready.wait()
+
+        tags = parsed['course_tag'].unique().tolist()
+        rng = random.Random(0)
+        paths = ([f"/course/{rng.choice(tags)}" for _ in range(200)]
+                 + [f"/search?q={rng.choice(tags)[:rng.randint(1, 5)]}" for _ in range(100)]
+                 + [f"/rank?k={k}" for k in (5, 10, 20)] + ["/rank?k=10&ascending=1", '/rank?k=10&weights={"Undervisning":2}'])
+        rng.shuffle(paths)
+
+        start = time.perf_counter()
+        latencies, failed = asyncio.run(_load(service.port, paths, requests, concurrency))
+        elapsed = time.perf_counter() - start
+        latencies = np.array(latencies) * 1000
+        cache = _get(service.port, "/health")["cache"]
+        print(f"{requests} requests over {concurrency} connections: {requests / elapsed:8.1f} requests/s "
+              f"p50 {np.percentile(latencies, 50):7.2f}ms p99 {np.percentile(latencies, 99):7.2f}ms "
+              f"cache hits {cache['hits'] / max(cache['hits'] + cache['misses'], 1):.1%} failed {len(failed)}")
+
+        # a new parse with more courses is picked up without a restart
+        time.sleep(0.05) # make sure the modification time changes
+        write_reports(report_location, reports * 40)
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            p.parse_reports(report_location).to_csv(reports_path, index=False, sep=";")
+        deadline = time.monotonic() + 30
+        while _get(service.port, "/health")["reports"] != reports * 2 and time.monotonic() < deadline:
+            time.sleep(0.1)
+        reloaded = _get(service.port, "/health")["reports"] == reports * 2
+        print(f"Reloaded the new parse: {reloaded}")
+    return {"requests_per_s": requests / elapsed, "p50_ms": float(np.percentile(latencies, 50)),
+            "p99_ms": float(np.percentile(latencies, 99)), "cache": cache, "failed": len(failed), "reloaded": reloaded}
+
+class _ReportHandler(BaseHTTPRequestHandler):
+    """
+        Serves synthetic reports at /<report_id> with an ETag. Every
+        missing-th report is a 404 and every flaky-th report answers 503
+        to its first request.
+    """
+    missing = 10
+    flaky = 7
+    hits = None # report id -> number of requests, set per server
+    lock = threading.Lock()
+
+    def do_GET(self):
+        report_id = int(self.path.strip("/"))
+        with self.lock:
+            self.hits[report_id] = self.hits.get(report_id, 0) + 1
+            first = self.hits[report_id] == 1
+        if report_id % self.missing == 0:
+            return self._send(404)
+        if report_id % self.flaky == 0 and first:
+            return self._send(503)
+        body = synthetic_report(report_id).encode("utf-8")
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        if self.headers.get("If-None-Match") == etag:
+            return self._send(304, headers={"ETag": etag})
+        self._send(200, body, {"ETag": etag, "Content-Type": "text/html; charset=utf-8"})
+
+    def _send(self, status: int, body: bytes = b"", headers: dict = {}):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def bench_fetcher(reports: int = 200, workers: int = 8, rate_limit: float = 50):
+    """
+        Fetches synthetic reports from a local server that answers 404 for
+        some reports and 503 once for others, then fetches them again with
+        the validators saved in a response store. Prints the reports per
+        second and checks the retries, the rate limit and that the second
+        pass only gets 304s.
+    """
+    handler = type("Handler", (_ReportHandler,), {"hits": {}})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    report_ids = list(range(1, reports + 1))
+    missing = [i for i in report_ids if i % handler.missing == 0]
+    flaky = [i for i in report_ids if i % handler.flaky == 0 and i % handler.missing != 0]
+    results, fetched = {}, {}
+    try:
+        with tempfile.TemporaryDirectory() as location:
+            save_location = os.path.join(location, "reports") + "/"
+            os.makedirs(save_location)
+            store = ResponseStore(os.path.join(location, "responses.sqlite"))
+            fetcher = s.Fetcher(max_workers=workers, rate_limit=rate_limit, retries=2, backoff=0.01,
+                                report_url=f"http://127.0.0.1:{server.server_port}/{{report_id}}")
+            for name in ("first", "conditional"):
+                before, sent = dict(fetcher.stats), sum(handler.hits.values())
+                start = time.perf_counter()
+                with contextlib.redirect_stderr(io.StringIO()):
+                    fetched[name] = fetcher.fetch_reports(report_ids, save_location, store)
+                elapsed = time.perf_counter() - start
+                stats = {key: fetcher.stats[key] - before[key] for key in fetcher.stats}
+                requests = sum(handler.hits.values()) - sent
+                results[name] = {**stats, "reports_per_s": reports / elapsed, "requests_per_s": requests / elapsed}
+                print(f"{name:>11}: {reports / elapsed:8.1f} reports/s {requests / elapsed:8.1f} requests/s "
+                      f"(limit {rate_limit}) {stats['fetched']} fetched {stats['unchanged']} unchanged "
+                      f"{stats['failed']} failed {stats['retried']} retries")
+            store.close()
+
+            first, conditional = results["first"], results["conditional"]
+            checks = {
+                "missing reports failed": first["failed"] == len(missing) and all(fetched["first"][i] is None for i in missing),
+                "5xx reports retried": first["retried"] == len(flaky) and all(fetched["first"][i] is not None for i in flaky),
+                "rate limit kept": max(first["requests_per_s"], conditional["requests_per_s"]) <= rate_limit * 1.1,
+                "second pass unchanged": conditional["unchanged"] == reports - len(missing) and conditional["fetched"] == 0,
+            }
+            for check, passed in checks.items():
+                print(f"{check:>22}: {passed}")
+            results["checks"] = checks
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+def compare(old_file: str, new_file: str):
+    """
+        Prints the change of every stage between two saved suite runs.
+    """
+    with open(old_file, 'r') as f:
+        old = json.load(f)
+    with open(new_file, 'r') as f:
+        new = json.load(f)
+    for name, stage in new["stages"].items():
+        if name not in old["stages"]:
+            continue
+        before = old["stages"][name]
+        print(f"{name:>18}: throughput {stage['docs_per_s'] / before['docs_per_s']:6.2f}x "
+              f"p50 {stage['p50_ms'] / before['p50_ms']:6.2f}x p99 {stage['p99_ms'] / before['p99_ms']:6.2f}x "
+              f"peak {stage['peak_mb'] / max(before['peak_mb'], 1e-9):6.2f}x")
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Benchmarks the parsing")
+    commands = arg_parser.add_subparsers(dest="command", required=True)
+
+    suite = commands.add_parser("suite", help="throughput, latency and memory of every parsing stage")
+    suite.add_argument("--reports", type=int, default=1000, help="number of synthetic reports")
+    suite.add_argument("--questions", type=int, default=20, help="questions per synthetic report")
+    suite.add_argument("--backend", default="bs4", choices=list(BACKENDS), help="html backend")
+    suite.add_argument("--output", help="json file to save the results to")
+
+    compare_parser = commands.add_parser("compare", help="compare two saved suite runs")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+
+    scaling = commands.add_parser("scaling", help="time per row of parse_reports for growing report sets")
+    scaling.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="number of rows in each report set")
+    scaling.add_argument("--workers", type=int, default=1, help="workers used by parse_reports")
+
+    commands.add_parser("backends", help="documents per second of every html backend")
+
+    course_text = commands.add_parser("course_text", help="per row and bulk course text parsing")
+    course_text.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="number of course texts in each column")
+
+    service_parser = commands.add_parser("service", help="load test of the query service")
+    service_parser.add_argument("--reports", type=int, default=1000, help="number of synthetic reports served")
+    service_parser.add_argument("--requests", type=int, default=5000, help="number of requests sent")
+    service_parser.add_argument("--concurrency", type=int, default=50, help="number of concurrent connections")
+
+    fetcher_parser = commands.add_parser("fetcher", help="retries, rate limit and conditional requests of the report fetcher")
+    fetcher_parser.add_argument("--reports", type=int, default=200, help="number of synthetic reports fetched")
+    fetcher_parser.add_argument("--workers", type=int, default=8, help="fetcher threads")
+    fetcher_parser.add_argument("--rate-limit", type=float, default=50, help="max requests per second")
+
+    args = arg_parser.parse_args()
+    if args.command == "suite":
+        bench_suite(args.reports, args.questions, args.backend, args.output)
+    elif args.command == "compare":
+        compare(args.old, args.new)
+    elif args.command == "scaling":
+        bench_scaling(args.sizes, args.workers)
+    elif args.command == "course_text":
+        bench_course_text(args.sizes)
+    elif args.command == "service":
+        bench_service(args.reports, args.requests, args.concurrency)
+    elif args.command == "fetcher":
+        bench_fetcher(args.reports, args.workers, args.rate_limit)
+    else:
+        bench_backends()
@@ -0,0 +1,73 @@
+"""
+cache.py - on-disk cache of parsed reports keyed by file and content hash
+"""
+import json
+import hashlib
+import sqlite3
+
+import pandas as pd
+
+class ParseCache:
+    def __init__(self, path: str, columns: list, version: int):
+        """
+            Opens (or creates) the sqlite cache at path. The cached rows
+            are only valid for the given parser version, the cache is
+            cleared if it was made by another version.
+        """
+        self.columns = columns
+        self.con = sqlite3.connect(path)
+        self.con.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.con.execute("CREATE TABLE IF NOT EXISTS files (file TEXT PRIMARY KEY, hash TEXT, rows TEXT)")
+        stored = self.con.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if stored is None or stored[0] != str(version):
+            self.clear()
+            self.con.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (str(version),))
+            self.con.commit()
+
+    @staticmethod
+    def hash(path: str):
+        """
+            Returns the hash of the content of the file.
+        """
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def clear(self):
+        """
+            Removes all the cached reports.
+        """
+        self.con.execute("DELETE FROM files")
+        self.con.commit()
+
+    def get(self, file: str, hash: str):
+        """
+            Returns the cached data frame of the file if it was cached with
+            the same content hash, otherwise None.
+        """
+        row = self.con.execute("SELECT rows FROM files WHERE file = ? AND hash = ?", (file, hash)).fetchone()
+        if row is None:
+            return None
+        return pd.DataFrame(json.loads(row[0]), columns=self.columns, dtype=object)
+
+    def put(self, file: str, hash: str, df: pd.DataFrame):
+        """
+            Caches the parsed data frame of the file. Call commit to write
+            the changes to disk.
+        """
+        # json keeps the difference between the int and str columns that the parser produces
+        rows = json.dumps(df[self.columns].values.tolist(), ensure_ascii=False)
+        self.con.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)", (file, hash, rows))
+
+    def prune(self, files: list):
+        """
+            Removes the cached reports whose file is not in the given files.
+        """
+        cached = {row[0] for row in self.con.execute("SELECT file FROM files")}
+        self.con.executemany("DELETE FROM files WHERE file = ?", [(file,) for file in cached - set(files)])
+
+    def commit(self):
+        self.con.commit()
+
+    def close(self):
+        self.con.commit()
+        self.con.close()
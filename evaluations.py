@@ -0,0 +1,121 @@
+"""
+evaluations.py - on demand evaluations of single courses
+
+Instead of a complete scrape, the report ids of a course are looked up in
+the report_map.csv files and only the reports that are not saved yet are
+fetched, then parsed. The parsed reports are kept in a bounded LRU cache.
+
+    from evaluations import get_course_evaluations
+    reports = get_course_evaluations("TDA357")
+"""
+import os
+import logging
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+import parser as p
+import scraper as s
+from archive import Archive
+
+logger = logging.getLogger(__name__)
+
+MAP_FILES = ["./data/bp/search/report_map.csv", "./data/mp/search/report_map.csv"]
+
+class CourseEvaluations:
+    def __init__(self, map_files: list = MAP_FILES, save_location: str = "./data/reports/", fetcher: s.Fetcher = None,
+                 archive: Archive = None, backend: str = "bs4", cache_size: int = 1024, workers: int = 8):
+        """
+            The fetched reports are saved to save_location (or the archive
+            if given) like update_reports does, so they are only fetched
+            once. At most cache_size parsed reports are kept in memory and
+            the reports of a course are fetched on workers threads.
+        """
+        self.map_files = map_files
+        self.save_location = save_location
+        self.fetcher = fetcher if fetcher is not None else s.Fetcher(max_workers=workers)
+        self.archive = archive
+        self.backend = backend
+        self.workers = workers
+        self.report = lru_cache(maxsize=cache_size)(self._report)
+        self._lock = threading.Lock()
+        self._index = {}
+        self._signature = None
+
+    def index(self):
+        """
+            Returns the report ids of every course tag from the report maps,
+            reloaded when the maps change.
+        """
+        signature = tuple(os.stat(f).st_mtime_ns if os.path.isfile(f) else None for f in self.map_files)
+        with self._lock:
+            if signature != self._signature:
+                maps = [pd.read_csv(f, sep=";") for f in self.map_files if os.path.isfile(f)]
+                report_map = pd.concat(maps).dropna(subset=['report_id']) if maps else pd.DataFrame(columns=p.search_cols)
+                report_map = report_map.drop_duplicates('report_id')
+                self._index = {tag: sorted(int(report_id) for report_id in ids) for tag, ids in report_map.groupby('course_tag')['report_id']}
+                self._signature = signature
+            return self._index
+
+    def report_ids(self, course_tag: str):
+        return self.index().get(course_tag, [])
+
+    def _report(self, report_id: int):
+        """
+            Returns the parsed report, read from disk if it is saved and
+            fetched otherwise. Raises if the fetch fails so it is not
+            cached.
+        """
+        if s.is_saved(report_id, self.save_location, self.archive):
+            if self.archive is not None:
+                html = self.archive.get(str(report_id))
+            else:
+                with open(f"{self.save_location}{report_id}.html", 'r', encoding="utf-8") as f:
+                    html = f.read()
+        else:
+            if self.archive is None:
+                os.makedirs(self.save_location, exist_ok=True)
+            html = s.get_report(report_id, self.save_location, self.fetcher, archive=self.archive)
+            if html is None:
+                raise IOError(f"Failed to fetch report {report_id}")
+        return p.parse_report(str(report_id), html, self.backend)
+
+    def get(self, course_tags):
+        """
+            Returns the parsed reports (report_cols in parser.py) of the
+            course tag or list of course tags, an unknown course has none.
+            Reports that fail to be fetched or parsed are left out.
+        """
+        if isinstance(course_tags, str):
+            course_tags = [course_tags]
+        report_ids = [report_id for tag in course_tags for report_id in self.report_ids(tag)]
+
+        def resolve(report_id):
+            try:
+                return self.report(report_id)
+            except Exception as e:
+                logger.warning(f"Skipping report {report_id}: {e}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            reports = [report for report in pool.map(resolve, report_ids) if report is not None]
+        if not reports:
+            return pd.DataFrame(columns=p.report_cols)
+        # copies, the cached frames are shared between the calls
+        return pd.concat(reports, ignore_index=True)
+
+# Created on the first call with the default locations
+_evaluations = None
+
+def get_course_evaluations(course_tags):
+    """
+        Returns the parsed reports of the course tag or list of course tags
+        using the report maps and reports in ./data, fetching only the
+        reports not saved yet.
+    """
+    global _evaluations
+    if _evaluations is None:
+        _evaluations = CourseEvaluations()
+    return _evaluations.get(course_tags)
@@ -0,0 +1,200 @@
+"""
+html_backend.py - pluggable html backends for the parser
+
+Every backend extracts the parts of the search, report and form pages the
+parser needs as plain python structures so the parsing logic in parser.py
+and mapper.py is shared. "bs4" is the BeautifulSoup html.parser reference,
+"lxml" and "selectolax" are C based and select the elements directly.
+
+    search_rows(html) -> [(th text, onclick of the first link or None)]
+    report(html) -> {"base_tables": number of artBaseTable divs, "h1": text,
+        "p": text, "categories": [(h3 text, srTextWrapper text, [(srtbl-h1
+        text, srtbl-rh text, [srtbl-cell texts])])] for divs with tables}
+    form_trees(html) -> {tree id: [(li text, tag of the first input)]}
+
+Missing elements are None so the parser fails the same way on every backend.
+"""
+TREE_IDS = ["treeCategories1", "treeCategories2", "treeCategories3"]
+
+class BeautifulSoupBackend:
+    name = "bs4"
+
+    @staticmethod
+    def _text(el):
+        return el.text if el is not None else None
+
+    @staticmethod
+    def search_rows(html: str):
+        from bs4 import BeautifulSoup
+
+        soup = BeautifulSoup(html, 'html.parser')
+        rows = []
+        for row in soup.find_all("tr", {"class": "srtbl-row"}):
+            link = row.find('a')
+            rows.append((BeautifulSoupBackend._text(row.find('th')), link.get('onclick') if link is not None else None))
+        return rows
+
+    @staticmethod
+    def report(html: str):
+        from bs4 import BeautifulSoup
+
+        text = BeautifulSoupBackend._text
+        soup = BeautifulSoup(html, 'html.parser')
+        divs = soup.find_all('div', {'class': 'artBaseTable'})
+        categories = []
+        for div in divs:
+            tables = div.find_all('table')
+            if not tables:
+                continue
+            questions = [(text(table.find('tr', {'class': 'srtbl-h1'})),
+                          text(table.find('th', {'class': 'srtbl-rh'})),
+                          [cell.text for cell in table.find_all('td', {'class': 'srtbl-cell'})]) for table in tables]
+            categories.append((text(div.find('h3')), text(div.find('div', {'class': 'srTextWrapper'})), questions))
+        return {"base_tables": len(divs), "h1": text(soup.find('h1')), "p": text(soup.find('p')), "categories": categories}
+
+    @staticmethod
+    def form_trees(html: str):
+        from bs4 import BeautifulSoup
+
+        soup = BeautifulSoup(html, 'html.parser')
+        trees = {}
+        for tree_id in TREE_IDS:
+            div = soup.find("div", {"id": tree_id})
+            if div is None:
+                trees[tree_id] = None
+                continue
+            items = []
+            for li in div.find_all('li'):
+                field = li.find('input')
+                items.append((li.text, field.get('tag') if field is not None else None))
+            trees[tree_id] = items
+        return trees
+
+def _has_class(name: str):
+    # xpath for an element with the class among its (space separated) classes
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+class LxmlBackend:
+    name = "lxml"
+
+    @staticmethod
+    def _root(html: str):
+        import lxml.html
+
+        return lxml.html.fromstring(html)
+
+    @staticmethod
+    def _first(el, xpath: str):
+        found = el.xpath(xpath)
+        return found[0] if found else None
+
+    @staticmethod
+    def _text(el):
+        return str(el.text_content()) if el is not None else None
+
+    @staticmethod
+    def search_rows(html: str):
+        first, text = LxmlBackend._first, LxmlBackend._text
+        rows = []
+        for row in LxmlBackend._root(html).xpath(f"//tr[{_has_class('srtbl-row')}]"):
+            link = first(row, ".//a")
+            rows.append((text(first(row, ".//th")), link.get('onclick') if link is not None else None))
+        return rows
+
+    @staticmethod
+    def report(html: str):
+        first, text = LxmlBackend._first, LxmlBackend._text
+        root = LxmlBackend._root(html)
+        divs = root.xpath(f"//div[{_has_class('artBaseTable')}]")
+        categories = []
+        for div in divs:
+            tables = div.xpath(".//table")
+            if not tables:
+                continue
+            questions = [(text(first(table, f".//tr[{_has_class('srtbl-h1')}]")),
+                          text(first(table, f".//th[{_has_class('srtbl-rh')}]")),
+                          [text(cell) for cell in table.xpath(f".//td[{_has_class('srtbl-cell')}]")]) for table in tables]
+            categories.append((text(first(div, ".//h3")), text(first(div, f".//div[{_has_class('srTextWrapper')}]")), questions))
+        return {"base_tables": len(divs), "h1": text(first(root, "//h1")), "p": text(first(root, "//p")), "categories": categories}
+
+    @staticmethod
+    def form_trees(html: str):
+        first, text = LxmlBackend._first, LxmlBackend._text
+        root = LxmlBackend._root(html)
+        trees = {}
+        for tree_id in TREE_IDS:
+            div = first(root, f"//div[@id='{tree_id}']")
+            if div is None:
+                trees[tree_id] = None
+                continue
+            items = []
+            for li in div.xpath(".//li"):
+                field = first(li, ".//input")
+                items.append((text(li), field.get('tag') if field is not None else None))
+            trees[tree_id] = items
+        return trees
+
+class SelectolaxBackend:
+    name = "selectolax"
+
+    @staticmethod
+    def _root(html: str):
+        from selectolax.lexbor import LexborHTMLParser
+
+        return LexborHTMLParser(html)
+
+    @staticmethod
+    def _text(el):
+        return el.text(deep=True) if el is not None else None
+
+    @staticmethod
+    def search_rows(html: str):
+        text = SelectolaxBackend._text
+        rows = []
+        for row in SelectolaxBackend._root(html).css("tr.srtbl-row"):
+            link = row.css_first("a")
+            rows.append((text(row.css_first("th")), link.attributes.get('onclick') if link is not None else None))
+        return rows
+
+    @staticmethod
+    def report(html: str):
+        text = SelectolaxBackend._text
+        root = SelectolaxBackend._root(html)
+        divs = root.css("div.artBaseTable")
+        categories = []
+        for div in divs:
+            tables = div.css("table")
+            if not tables:
+                continue
+            questions = [(text(table.css_first("tr.srtbl-h1")),
+                          text(table.css_first("th.srtbl-rh")),
+                          [text(cell) for cell in table.css("td.srtbl-cell")]) for table in tables]
+            categories.append((text(div.css_first("h3")), text(div.css_first("div.srTextWrapper")), questions))
+        return {"base_tables": len(divs), "h1": text(root.css_first("h1")), "p": text(root.css_first("p")), "categories": categories}
+
+    @staticmethod
+    def form_trees(html: str):
+        text = SelectolaxBackend._text
+        root = SelectolaxBackend._root(html)
+        trees = {}
+        for tree_id in TREE_IDS:
+            div = root.css_first(f"div#{tree_id}")
+            if div is None:
+                trees[tree_id] = None
+                continue
+            items = []
+            for li in div.css("li"):
+                field = li.css_first("input")
+                items.append((text(li), field.attributes.get('tag') if field is not None else None))
+            trees[tree_id] = items
+        return trees
+
+BACKENDS = {backend.name: backend for backend in [BeautifulSoupBackend, LxmlBackend, SelectolaxBackend]}
+
+def get_backend(name: str = "bs4"):
+    """
+        Returns the backend with the given name.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown html backend {name}, available: {', '.join(BACKENDS)}")
+    return BACKENDS[name]
@@ -1,19 +1,67 @@
+import pandas as pd
+
 from mapper import Mapper
 import parser as p
 import scraper as s
+from metrics import METRICS
+from pipeline import Pipeline
+from store import ResponseStore
+from ledger import JobLedger
+from timeseries import TimeSeries
 
 """ Generates the report.csv file. Complete scrape """
 
-mapper = Mapper()
-mapper.update_map()
-mapper.driver.quit()
+# Searches are refreshed weekly and reports monthly
+SEARCH_MAX_AGE = 7 * 24 * 3600
+REPORT_MAX_AGE = 30 * 24 * 3600
+
+def main(streaming: bool = True, prometheus: str = None):
+    """
+        With streaming the searches, fetching and parsing overlap in a 
+        pipeline, otherwise every stage finishes before the next starts.
+        The metrics of the run are saved to ./data/run_metrics.json and in
+        the prometheus text format to the prometheus path if given.
+    """
+    METRICS.reset()
+    try:
+        run(streaming)
+    finally:
+        METRICS.save("./data/run_metrics.json")
+        if prometheus:
+            METRICS.save_prometheus(prometheus)
+
+def run(streaming: bool):
+    mapper = Mapper()
+    mapper.update_map()
+    mapper.quit()
+
+    # Validators and fetch times of earlier runs
+    store = ResponseStore("./data/responses.sqlite")
+    # History of every course across the runs
+    timeseries = TimeSeries("./data/timeseries.sqlite")
+    # Searches and reports left by an interrupted run
+    ledger = JobLedger("./data/jobs.sqlite")
+
+    if streaming:
+        Pipeline(store=store, search_max_age=SEARCH_MAX_AGE, report_max_age=REPORT_MAX_AGE, timeseries=timeseries, ledger=ledger).run()
+        return
+
+    s.update_courses(s.BP_URL, "./data/bp/", store, SEARCH_MAX_AGE, ledger=ledger)
+    s.update_courses(s.MP_URL, "./data/mp/", store, SEARCH_MAX_AGE, ledger=ledger)
+
+    p.update_searches()
 
-s.update_courses(s.BP_URL, "./data/bp/")
-s.update_courses(s.MP_URL, "./data/mp/")
+    for map_file in ["./data/bp/search/report_map.csv", "./data/mp/search/report_map.csv"]:
+        timeseries.add_programmes(pd.read_csv(map_file, sep=";"))
+        # only the new and refreshed reports are returned
+        timeseries.ingest_html(s.update_reports(map_file, store=store, max_age=REPORT_MAX_AGE, ledger=ledger))
 
-p.update_searches()
+    for report_id, error in ledger.failed("report"):
+        print(f"Gave up on report {report_id}: {error}")
+    # The scrape is complete, the next run is a new refresh
+    ledger.clear()
 
-s.update_reports("./data/bp/search/report_map.csv")
-s.update_reports("./data/mp/search/report_map.csv")
+    p.parse_reports("./data/reports", save=True, cache="./data/report_cache.sqlite")
 
-p.parse_reports("./data/reports", save=True)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+ledger.py - persistent ledger of the scrape jobs
+
+Every search and report to fetch is a job in a sqlite table with its state
+(pending, in_flight, done or failed), attempt count and last error. The
+scrape stages claim batches of jobs from the ledger and mark them done or
+failed, so a rerun after a crash skips the finished jobs and retries the
+failed ones. Claiming is one transaction, several processes can drain the
+same ledger. A claimed job that is not finished within the lease (its
+worker died) can be claimed again.
+"""
+import os
+import time
+import socket
+import sqlite3
+import threading
+
+PENDING = "pending"
+IN_FLIGHT = "in_flight"
+DONE = "done"
+FAILED = "failed"
+
+class JobLedger:
+    def __init__(self, path: str, lease: float = 600, max_attempts: int = 5, backoff: float = 5):
+        """
+            Opens (or creates) the ledger at path. A failed job is retried
+            after backoff * 2^(attempts - 1) seconds until it has failed
+            max_attempts times.
+        """
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+        # autocommit, the transactions are explicit so claims are atomic between processes
+        self.con = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute("CREATE TABLE IF NOT EXISTS jobs (stage TEXT, key TEXT, state TEXT, attempts INTEGER, worker TEXT, "
+                         "available_at REAL, error TEXT, updated_at REAL, PRIMARY KEY (stage, key))")
+        self.con.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (stage, state, available_at)")
+        self._lock = threading.Lock()
+        self.release_dead()
+
+    def release_dead(self):
+        """
+            Makes the jobs in flight in dead processes of this host
+            claimable again without waiting for their lease, so a restart
+            resumes right away. Returns the number of jobs released.
+        """
+        host = socket.gethostname()
+        dead = []
+        with self._lock:
+            workers = [row[0] for row in self.con.execute("SELECT DISTINCT worker FROM jobs WHERE state = ?", (IN_FLIGHT,))]
+        for worker in workers:
+            worker_host, _, pid = worker.rpartition(":")
+            if worker_host != host or not pid.isdigit() or worker == self.worker:
+                continue
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                dead.append(worker)
+            except PermissionError:
+                pass # alive, owned by another user
+        with self._lock:
+            before = self.con.total_changes
+            self.con.executemany("UPDATE jobs SET available_at = 0 WHERE state = ? AND worker = ?", [(IN_FLIGHT, worker) for worker in dead])
+            return self.con.total_changes - before
+
+    def add(self, stage: str, keys: list):
+        """
+            Adds the jobs of the stage that are not in the ledger yet as
+            pending. Returns the number of jobs added.
+        """
+        now = time.time()
+        with self._lock:
+            before = self.con.total_changes
+            self.con.execute("BEGIN IMMEDIATE")
+            self.con.executemany("INSERT OR IGNORE INTO jobs VALUES (?, ?, ?, 0, NULL, 0, NULL, ?)",
+                                 [(stage, str(key), PENDING, now) for key in keys])
+            self.con.execute("COMMIT")
+            return self.con.total_changes - before
+
+    def claim(self, stage: str, n: int = 1):
+        """
+            Marks up to n claimable jobs of the stage in flight for this
+            worker and returns their keys. Claimable are the pending jobs,
+            the failed jobs due for a retry and the in flight jobs whose
+            lease ran out.
+        """
+        now = time.time()
+        with self._lock:
+            self.con.execute("BEGIN IMMEDIATE")
+            try:
+                keys = [row[0] for row in self.con.execute(
+                    "SELECT key FROM jobs WHERE stage = ? AND available_at <= ? AND "
+                    "(state = ? OR state = ? OR (state = ? AND attempts < ?)) ORDER BY attempts, rowid LIMIT ?",
+                    (stage, now, PENDING, IN_FLIGHT, FAILED, self.max_attempts, n))]
+                self.con.executemany("UPDATE jobs SET state = ?, attempts = attempts + 1, worker = ?, available_at = ?, updated_at = ? "
+                                     "WHERE stage = ? AND key = ?",
+                                     [(IN_FLIGHT, self.worker, now + self.lease, now, stage, key) for key in keys])
+                self.con.execute("COMMIT")
+            except BaseException:
+                self.con.execute("ROLLBACK")
+                raise
+            return keys
+
+    def done(self, stage: str, keys: list):
+        with self._lock:
+            self.con.executemany("UPDATE jobs SET state = ?, error = NULL, updated_at = ? WHERE stage = ? AND key = ?",
+                                 [(DONE, time.time(), stage, str(key)) for key in keys])
+
+    def fail(self, stage: str, key, error: str = None):
+        """
+            Marks the job failed, it is claimable again after the backoff
+            unless it has failed max_attempts times.
+        """
+        now = time.time()
+        with self._lock:
+            self.con.execute("UPDATE jobs SET state = ?, error = ?, available_at = ? + ? * (1 << MAX(attempts - 1, 0)), updated_at = ? "
+                             "WHERE stage = ? AND key = ?", (FAILED, error, now, self.backoff, now, stage, str(key)))
+
+    def batches(self, stage: str, size: int):
+        """
+            Yields batches of claimed jobs until the stage has no pending
+            jobs or failed jobs left to retry, waiting for the retries that
+            are not due yet. Jobs in flight in other workers are left to
+            them.
+        """
+        while True:
+            keys = self.claim(stage, size)
+            if keys:
+                yield keys
+                continue
+            with self._lock:
+                due = self.con.execute("SELECT MIN(available_at) FROM jobs WHERE stage = ? AND state = ? AND attempts < ?",
+                                       (stage, FAILED, self.max_attempts)).fetchone()[0]
+            if due is None:
+                return
+            time.sleep(min(max(due - time.time(), 0.05), self.lease))
+
+    def counts(self, stage: str = None):
+        """
+            Returns the number of jobs in every state, of the stage if given.
+        """
+        sql, params = "SELECT state, COUNT(*) FROM jobs", ()
+        if stage is not None:
+            sql, params = sql + " WHERE stage = ?", (stage,)
+        with self._lock:
+            return dict(self.con.execute(sql + " GROUP BY state", params).fetchall())
+
+    def failed(self, stage: str):
+        """
+            Returns the keys and last errors of the jobs that failed every
+            attempt.
+        """
+        with self._lock:
+            return self.con.execute("SELECT key, error FROM jobs WHERE stage = ? AND state = ? AND attempts >= ?",
+                                    (stage, FAILED, self.max_attempts)).fetchall()
+
+    def clear(self, stage: str = None):
+        """
+            Removes the jobs (of the stage if given), for the start of a new
+            refresh once a run is complete.
+        """
+        with self._lock:
+            if stage is None:
+                self.con.execute("DELETE FROM jobs")
+            else:
+                self.con.execute("DELETE FROM jobs WHERE stage = ?", (stage,))
+
+    def close(self):
+        with self._lock:
+            self.con.close()
@@ -2,17 +2,46 @@
 mapper.py - mapping the input fields in the search page to their ids
 """
 import os
-import pandas as pd
+import requests
 
 from datetime import date
-from bs4 import BeautifulSoup
-from seleniumwire import webdriver  # Import from seleniumwire
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service as ChromeService
-from webdriver_manager.chrome import ChromeDriverManager
+from parser import parse_form_html
+from scraper import HEADERS
+from html_backend import get_backend
+
+BP_SEARCH_URL = "https://course-eval.portal.chalmers.se/sr/ar/4257/sv" # Search page for bachelor programmes
+MP_SEARCH_URL = "https://course-eval.portal.chalmers.se/sr/ar/4248/sv" # Search page for master programmes
 
 class Mapper:
-    def __init__(self):
+    def __init__(self, browser: bool = False):
+        """
+            Fetches the search pages with plain http requests. The headless
+            chrome driver is only started if browser is set or if a page
+            fetched over http is missing the search form.
+        """
+        self.session = requests.Session()
+        self.session.headers.update(HEADERS)
+        self.driver = None
+        self.page_source = None
+        if browser:
+            self.start_driver()
+
+        # Create data folder if it doesn't exist
+        today = date.today()
+        self.data_location = today.strftime("data_%Y%m%d")
+        os.makedirs(self.data_location, exist_ok=True)
+        os.makedirs(self.data_location+"/mp", exist_ok=True)
+        os.makedirs(self.data_location+"/bp", exist_ok=True)
+
+    def start_driver(self):
+        """
+            Starts the headless chrome driver, imported here since selenium
+            and the driver download are only needed for the fallback.
+        """
+        from seleniumwire import webdriver  # Import from seleniumwire
+        from selenium.webdriver.chrome.options import Options
+        from webdriver_manager.chrome import ChromeDriverManager
+
         options = Options()
         options.add_argument('--headless')
 
@@ -43,73 +72,65 @@ class Mapper:
         # Set the interceptor on the driver
         self.driver.request_interceptor = interceptor
 
-        # Create data folder if it doesn't exist
-        today = date.today()
-        self.data_location = today.strftime("data_%Y%m%d")
-        os.makedirs(self.data_location, exist_ok=True)
-        os.makedirs(self.data_location+"/mp", exist_ok=True)
-        os.makedirs(self.data_location+"/bp", exist_ok=True)
+    def quit(self):
+        """
+            Quits the chrome driver if it was started.
+        """
+        if self.driver is not None:
+            self.driver.quit()
+            self.driver = None
 
     def get_data(self):
-        if self.driver.page_source is None:
+        if self.page_source is None:
             print("No data collected")
-        return self.driver.page_source
+        return self.page_source
+
+    @staticmethod
+    def has_form(text, backend: str = "bs4"):
+        """
+            Returns True if every category tree of the search form is in
+            the html with at least one field, the trees are empty in a page
+            that is still to be built by javascript.
+        """
+        if not text:
+            return False
+        trees = get_backend(backend).form_trees(text)
+        return all(items and any(name != "Markera alla" for name, _ in items) for items in trees.values())
 
     def fetch(self, master=False):
         """
             Fetches the search page for either master programme or 
             bachelor programme and saves the resulting html in 
-            self.data.
+            self.page_source. Falls back to the chrome driver if the 
+            page fetched over http has no search form.
         """
-        if master:
-            url = "https://course-eval.portal.chalmers.se/sr/ar/4248/sv" # Search page for master programmes
-        else:
-            url = "https://course-eval.portal.chalmers.se/sr/ar/4257/sv" # Search page for bachelor programmes
+        url = MP_SEARCH_URL if master else BP_SEARCH_URL
+        self.page_source = None
+        if self.driver is None:
+            r = self.session.get(url)
+            if r.status_code == 200 and self.has_form(r.text):
+                self.page_source = r.text
+                return self.page_source
+            print(f"No search form in the http response from {url}, falling back to the browser")
+            self.start_driver()
         self.driver.get(url)
-        return self.driver.page_source
+        self.page_source = self.driver.page_source
+        return self.page_source
 
     def save_html(self, filename):
         """
             Saves the data fetched to a file
         """
         with open(filename, 'w') as f:
-            f.write(self.driver.page_source)
+            f.write(self.page_source)
 
-    def parse(self, text):
+    def parse(self, text, backend: str = "bs4"):
         """
             Parses the html and returns a dictionary of the input fields
             and their ids and returns a list of data frames with the 
             columns ['tag', 'name', 'sid'].
         """
-        soup = BeautifulSoup(text, 'html.parser')
-        categories = {
-            "Programme": soup.find("div", {"id": "treeCategories1"}),
-            "Year": soup.find("div", {"id": "treeCategories2"}),
-            "LP": soup.find("div", {"id": "treeCategories3"})
-          }
-        fields = {}
-
-        for category, div in categories.items():
-            lis = div.find_all('li')
-            field = pd.DataFrame(columns=['tag', 'name', 'sid'])
-
-            for li in lis:
-                if li.text != "Markera alla":
-                    # Has to handle ZBASS- Tekniskt basår, TSLOG - Sjöfart och logistik, 2013/2014 or Läsperiod 1
-                    tag = li.text
-                    name = ""
-
-                    if "-" in li.text: 
-                        keys = li.text.split("-")
-                        tag = keys[0].strip()
-                        name = keys[1].strip()
-                    
-                    sid = li.find('input')['tag']
-                    # use concat to add a new row to the dataframe
-                    field = pd.concat([field, pd.DataFrame([[tag, name, sid]], columns=['tag', 'name', 'sid'])], ignore_index=True)
-            fields[category] = field
-
-        return fields
+        return parse_form_html(text, backend)
 
     def parse_file(self, filename):
         """
@@ -148,9 +169,10 @@ class Mapper:
             field.to_csv(self.data_location+"/bp/"+category+"_map.csv", index=False, sep=';')
         print("Saved bachelor map")
 
-mapper = Mapper()
-mapper.update_map()
-mapper.driver.quit()
+if __name__ == "__main__":
+    mapper = Mapper()
+    mapper.update_map()
+    mapper.quit()
 
 #mapper.fetch(master=True)
 #mapper.save_html("data/mp_search.html")
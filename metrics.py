@@ -0,0 +1,145 @@
+"""
+metrics.py - counters, histograms and timers for the scrape/parse pipeline
+
+The scraper and parser record into the module level METRICS registry, the
+run summary can be saved as json or exported in the prometheus text format.
+"""
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Upper bounds in seconds, covers both single parses and http requests
+DEFAULT_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+class Histogram:
+    def __init__(self, buckets: list = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+            "buckets": {str(bound): count for bound, count in zip(self.buckets + ["+Inf"], self.counts)},
+        }
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+            Removes everything recorded, for the start of a new run.
+        """
+        with self._lock:
+            self.started = time.time()
+            self.counters = {} # (name, labels) -> value
+            self.histograms = {} # (name, labels) -> Histogram
+
+    @staticmethod
+    def _key(name: str, labels: dict):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """
+            Increments the counter with the given labels.
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        """
+            Records a value in the histogram with the given labels.
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """
+            Records the time spent in the with block in the histogram.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def summary(self):
+        """
+            Returns everything recorded as a json serializable dict.
+        """
+        def label_str(labels):
+            return ",".join(f"{k}={v}" for k, v in labels)
+
+        with self._lock:
+            counters, histograms = {}, {}
+            for (name, labels), value in sorted(self.counters.items()):
+                counters.setdefault(name, {})[label_str(labels)] = value
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                histograms.setdefault(name, {})[label_str(labels)] = histogram.summary()
+            return {"started": self.started, "elapsed": time.time() - self.started, "counters": counters, "histograms": histograms}
+
+    def save(self, path: str):
+        """
+            Saves the run summary as json.
+        """
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def to_prometheus(self, prefix: str = "kursval_"):
+        """
+            Returns everything recorded in the prometheus text format.
+        """
+        def label_str(labels, extra=()):
+            labels = list(labels) + list(extra)
+            if not labels:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+        lines = []
+        with self._lock:
+            seen = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in seen:
+                    lines.append(f"# TYPE {prefix}{name} counter")
+                    seen.add(name)
+                lines.append(f"{prefix}{name}{label_str(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in seen:
+                    lines.append(f"# TYPE {prefix}{name} histogram")
+                    seen.add(name)
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ["+Inf"], histogram.counts):
+                    cumulative += count
+                    lines.append(f"{prefix}{name}_bucket{label_str(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{prefix}{name}_sum{label_str(labels)} {histogram.sum}")
+                lines.append(f"{prefix}{name}_count{label_str(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def save_prometheus(self, path: str):
+        with open(path, 'w') as f:
+            f.write(self.to_prometheus())
+
+METRICS = Metrics()
@@ -1,25 +1,66 @@
 import os
 import re
+import time
+import logging
 import pandas as pd
 import str_utils as str_utils
+from cache import ParseCache
+from archive import Archive, search_location
+from questions import QuestionRegistry, STAT_HEADERS, END_CATEGORIES
+from storage import write_reports
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from html_backend import get_backend
+from metrics import METRICS
 from tqdm import tqdm
 
-from bs4 import BeautifulSoup
+logger = logging.getLogger(__name__)
 
-def parse_search(search_path: str, save: bool = False):
+search_cols = ['programme', 'course_tag', 'report_id']
+
+def parse_search_html(programme: str, html: str, backend: str = "bs4"):
+    """
+        Parses a single search html and returns a list of rows with the
+        programme, course_tag and report_id of every course in it.
+    """
+    start = time.perf_counter()
+    rows = []
+    course_rows = get_backend(backend).search_rows(html)
+
+    logger.debug(f"Found {len(course_rows)} courses")
+    for name, onclick in course_rows:
+        course_tag, _, _, _, _, parsed = str_utils.match_course_text(name)
+        if not parsed:
+            METRICS.inc("course_text_failures_total", stage="search")
+            logger.debug(f"Unexpected course text {name!r}")
+        # regex get the id from the on click argument. Ex: 'showReport('3284|-');return false;'
+        if onclick is not None:
+            report_id = int(re.search(r"(\d+)", onclick).group(1))
+        else:
+            report_id = None
+            logger.debug(f"Course {name} has no report")
+        rows.append([programme, course_tag, report_id])
+    record_parse("search", time.perf_counter() - start, len(rows))
+    return rows
+
+def parse_search(search_path: str, save: bool = False, backend: str = "bs4", archive: str = None):
     """
         Parses the search htmls in the given path and returns a data
-        frame containing the programme, course_tag and report_id.
+        frame containing the programme, course_tag and report_id. backend
+        is the html backend used (see html_backend.py). With an archive 
+        path the searches are read from the archive instead, the report 
+        maps are still saved to the search path.
     """
-    cols = ['programme', 'course_tag', 'report_id']
-    full_data = pd.DataFrame(columns=cols)
+    if archive is not None:
+        return _parse_archived_search(search_path, save, backend, archive)
+    full_rows = []
     path = search_path
 
     print("Parsing search path")
     print(f"Found {len(os.listdir(search_path))} directories")
     # loop through all the directories in the path
     for programme_dir in os.listdir(search_path):
-        data = pd.DataFrame(columns=cols) # Reset for each program
+        rows = [] # Reset for each program
         path = search_path+"/"+programme_dir
 
         # check if the file is a directory
@@ -31,158 +72,405 @@ def parse_search(search_path: str, save: bool = False):
         for f in os.listdir(path):
             if f.endswith(".html"):
                 with open(path + "/" + f, 'r') as html:
-                    print(f"    Parsing {f}...")
-                    soup = BeautifulSoup(html.read(), 'html.parser')
-                    rows = soup.find_all("tr", {"class": "srtbl-row"})
-
-                    print(f"      Found {len(rows)} courses")
-                    for row in rows:
-                        name = row.find('th').text
-                        course_tag = str_utils.parse_course_text(name)[0]
-                        # regex get the id from the on click argument. Ex: 'showReport('3284|-');return false;'
-                        report_link = row.find('a')
-                        if report_link is not None:
-                            report_id = int(re.search(r"(\d+)", report_link['onclick']).group(1))
-                        else:
-                            report_id = None
-                            print(f"      Course {name} has no report")
-                        data = pd.concat([data, pd.DataFrame([[programme_dir, course_tag, report_id]], columns=cols)])
+                    logger.debug(f"Parsing {f}...")
+                    rows.extend(parse_search_html(programme_dir, html.read(), backend))
         
         print(f"  Done parsing directory {programme_dir}")
         if save:
+            data = pd.DataFrame(rows, columns=search_cols, dtype=object)
             data.to_csv(path+"/report_map.csv", index=False, sep=";") # Not really needed, but nice for debugging
-        full_data = pd.concat([full_data, data])
+        full_rows.extend(rows)
 
+    # Build the frame once at the end, appending row by row copies the whole frame each time
+    full_data = pd.DataFrame(full_rows, columns=search_cols, dtype=object)
     if save:
         full_data.to_csv(search_path+"/report_map.csv", index=False, sep=";")
     print("Done parsing search path")
     return full_data
 
+def _parse_archived_search(search_path: str, save: bool, backend: str, archive_path: str):
+    # only the searches of this map location are read
+    prefix = search_location(search_path) + "/"
+    archive = Archive(archive_path)
+    programmes = {}
+    for key, html in archive.items(prefix):
+        programmes.setdefault(key[len(prefix):].split("/")[0], []).append(html)
+    archive.close()
+
+    print("Parsing search archive")
+    print(f"Found {len(programmes)} programmes")
+    full_rows = []
+    for programme, htmls in programmes.items():
+        rows = []
+        for html in htmls:
+            rows.extend(parse_search_html(programme, html, backend))
+        print(f"  Done parsing programme {programme}")
+        if save:
+            os.makedirs(search_path+"/"+programme, exist_ok=True)
+            data = pd.DataFrame(rows, columns=search_cols, dtype=object)
+            data.to_csv(search_path+"/"+programme+"/report_map.csv", index=False, sep=";")
+        full_rows.extend(rows)
+
+    full_data = pd.DataFrame(full_rows, columns=search_cols, dtype=object)
+    if save:
+        full_data.to_csv(search_path+"/report_map.csv", index=False, sep=";")
+    print("Done parsing search archive")
+    return full_data
+
 def update_searches():
     parse_search("./data/bp/search", save=True)
     parse_search("./data/mp/search", save=True)
 
+# Bump when the parsing logic changes to invalidate the parse cache
+PARSER_VERSION = 2
+
 report_cols = ['course_tag', 'course_name', 'period', 'reading_period', 'report_id', 'answers_count', 'respondents_count', 'category', 'question', 'mean', 'median']
 
-def parse_report(report_id: int, report: str):
+def parse_report(report_id: int, report: str, backend: str = "bs4"):
     """
         Parses the given report html and returns a dict with the parsed data.
     """
-    soup = BeautifulSoup(report, 'html.parser')
-    report_cols = ['course_tag', 'course_name', 'period', 'reading_period', 'report_id', 'answers_count', 'respondents_count', 'category', 'question', 'mean', 'median']
-    df = pd.DataFrame(columns=report_cols)
+    page = get_backend(backend).report(report)
+    rows = []
 
     # Check if the report is empty
-    if len(soup.find_all('div', {'class': 'artBaseTable'})) < 3:
-        print(f"Report {report_id} is empty")
-        return df
+    if page["base_tables"] < 3:
+        logger.debug(f"Report {report_id} is empty")
+        return pd.DataFrame(columns=report_cols)
 
-    course = soup.find('h1').text
-    course_tag, course_name, period, reading_period = str_utils.parse_course_text(course)
-    course_info = soup.find('p').text
+    course = page["h1"]
+    course_tag, course_name, period, reading_period, _, parsed = str_utils.match_course_text(course)
+    if not parsed:
+        # only the tag is trusted, the rest stays empty instead of a guess
+        METRICS.inc("course_text_failures_total", stage="report")
+        logger.warning(f"Unexpected course text in report {report_id}: {course!r}")
+    course_info = page["p"]
     numbers = re.findall(r'\d+', course_info)
     answers_count = int(numbers[1])
     respondents_count = int(numbers[0])
 
-    categories_divs = soup.find_all('div', {'class': 'artBaseTable'})
-    for div in categories_divs:
-        if div.find('table') is None: # Category div no tables
-            continue
-
-        h3 = div.find('h3')
+    # Only the category divs with tables
+    for h3, text_wrapper, questions_tables in page["categories"]:
         if h3 is not None:
-            category = h3.text.strip()
+            category = h3.strip()
         else:
-            category = div.find('div', {'class': 'srTextWrapper'}).text.strip()
+            category = text_wrapper.strip()
 
         category_start_index = re.search(r'[a-zA-ZåäöÅÄÖ]', category).start() # Find the first letter in the category
         category = category[category_start_index:] # remove the number from the category name
 
-        questions_tables = div.find_all('table')
-        for table in questions_tables: # Skips the categories without any tables/"numerics" (ex: "Vad i kursen bör bevaras till nästa kursomgång?")
-            table_h1 = table.find('tr', {'class': 'srtbl-h1'})
-            if table_h1 is None: # Skip the table if it has no header
+        for table_title, question_text, stat_cells in questions_tables: # Skips the categories without any tables/"numerics" (ex: "Vad i kursen bör bevaras till nästa kursomgång?")
+            if table_title is None: # Skip the table if it has no header
                 continue
-            table_title = table_h1.text
-            if table_title != "\xa0MeanMedian" and table_title != "\xa0MedelvärdeMedian": # Skip the table if it has no mean/median
+            if table_title not in STAT_HEADERS: # Skip the table if it has no mean/median
                 continue
-            question_text = table.find('th', {'class': 'srtbl-rh'}).text.strip()
-            stat_cells = table.find_all('td', {'class': 'srtbl-cell'})
-            question_mean = stat_cells[0].text.strip()
-            question_median = stat_cells[1].text.strip()
-            df = pd.concat([df, 
-                pd.DataFrame(
-                    [[course_tag, course_name, period, reading_period, report_id, answers_count, respondents_count, category, question_text, question_mean, question_median]], columns=report_cols
-                )
-            ])
-        
-        end_categories = ["Overall impression", "Sammanfattande intryck", "Vad är Ditt sammanfattande intryck av kursen?", "What is your overall impression of the course?"]
-        if category in end_categories:
+            question_text = question_text.strip()
+            question_mean = stat_cells[0].strip()
+            question_median = stat_cells[1].strip()
+            rows.append([course_tag, course_name, period, reading_period, report_id, answers_count, respondents_count, category, question_text, question_mean, question_median])
+
+        if category in END_CATEGORIES:
             # Stop parsing after the overall impression category since after that it is just very detailed questions
             break
 
-    return df
+    return pd.DataFrame(rows, columns=report_cols, dtype=object)
 
-def parse_reports(reports_path: str, save: bool = False):
+def record_parse(stage: str, seconds: float, rows: int):
     """
-        Parses the given reports and returns a list of data frames with the 
-        parsed data.
+        Records the parse time and rows emitted of a document in the 
+        metrics, a report without rows is counted as empty.
     """
-    print("Parsing reports")
-    print(f"Found {len(os.listdir(reports_path))} directories")
-    reports = pd.DataFrame(columns=report_cols)
+    METRICS.observe("parse_seconds", seconds, stage=stage)
+    METRICS.inc("rows_emitted_total", rows, stage=stage)
+    METRICS.inc("documents_parsed_total", stage=stage)
+    if stage == "report" and rows == 0:
+        METRICS.inc("empty_reports_total")
+
+def _parse_report_file(path: str, backend: str = "bs4"):
+    """
+        Parses a single report file and returns a tuple of the file name,
+        the parsed data frame, the error if the parsing failed and the 
+        parse time. Top level so it can be sent to the worker processes,
+        the metrics are recorded by the caller since the worker processes
+        have their own.
+    """
+    file = os.path.basename(path)
+    start = time.perf_counter()
+    try:
+        with open(path, 'r') as f:
+            html = f.read()
+        report_id = file.split('.')[0]
+        return file, parse_report(report_id, html, backend), None, time.perf_counter() - start
+    except Exception as e:
+        return file, None, e, time.perf_counter() - start
+
+# Archives opened by the worker processes, one per archive path
+_archives = {}
+
+def _parse_archived_report(key: str, archive, backend: str = "bs4"):
+    """
+        Same as _parse_report_file for the report stored under the key in
+        the archive. The worker processes get the path of the archive and
+        open it once per process.
+    """
+    start = time.perf_counter()
+    try:
+        if isinstance(archive, str):
+            if archive not in _archives:
+                _archives[archive] = Archive(archive)
+            archive = _archives[archive]
+        return key, parse_report(key, archive.get(key), backend), None, time.perf_counter() - start
+    except Exception as e:
+        return key, None, e, time.perf_counter() - start
+
+def _report_keys(archive: Archive):
+    # search pages are keyed by programme/page, reports by report id
+    return [key for key in archive.keys() if "/" not in key]
+
+def _parse_paths(paths: list, parse_file, pool: ProcessPoolExecutor = None, workers: int = 1, cache: ParseCache = None,
+                 progress: tqdm = None, hash_file = None):
+    """
+        Parses the report files, in the pool if given and only the files 
+        not in the cache if given. Returns a dict of path to the parsed 
+        data frame, the failed files and the number of cached reports.
+        hash_file returns the hash of a path for the cache (the hash of 
+        the file by default).
+    """
+    parsed = {}
+    skipped = []
+    to_parse = paths
+    if cache is not None:
+        hash_file = hash_file or cache.hash
+        hashes = {path: hash_file(path) for path in paths}
+        for path in paths:
+            report = cache.get(path, hashes[path])
+            if report is not None:
+                parsed[path] = report
+        to_parse = [path for path in paths if path not in parsed]
+        METRICS.inc("cached_reports_total", len(parsed))
+        if progress is not None:
+            progress.update(len(parsed))
+
+    if pool is None:
+        results = map(parse_file, to_parse)
+    else:
+        # chunks keep the overhead of sending the reports to the workers low, map keeps the order
+        chunksize = max(1, len(to_parse) // (4 * (workers or os.cpu_count() or 1)))
+        results = pool.map(parse_file, to_parse, chunksize=chunksize)
+    for path, (file, report, error, seconds) in zip(to_parse, results):
+        if progress is not None:
+            progress.update(1)
+        if error is not None:
+            logger.warning(f"Error parsing {file}: {error}")
+            METRICS.inc("decode_failures_total" if isinstance(error, UnicodeDecodeError) else "parse_failures_total")
+            skipped.append(file)
+            continue
+        record_parse("report", seconds, len(report))
+        parsed[path] = report
+        if cache is not None:
+            cache.put(path, hashes[path], report)
+    if cache is not None:
+        cache.commit()
+    return parsed, skipped, len(paths) - len(to_parse)
+
+def _stream_reports(reports_path: str, output: str, parse_file, pool: ProcessPoolExecutor, workers: int, cache: ParseCache, chunk_size: int,
+                    archive: Archive = None, registry: QuestionRegistry = None):
+    """
+        Parses the reports in chunks of chunk_size files and appends the 
+        rows of every chunk to the output csv. After every chunk the size
+        of the output and the finished files are appended to a progress
+        file next to the output, a rerun truncates the output to the last
+        finished chunk and skips its files. With an archive the reports
+        in it are parsed instead of the files in reports_path, with a
+        registry the categories and questions are written as ids. Returns
+        the failed files.
+    """
+    progress_file = output + ".progress"
+    done = set()
+    offset = 0
+    if os.path.isfile(progress_file) and os.path.isfile(output):
+        with open(progress_file, 'r', encoding="utf-8") as f:
+            for line in f:
+                if "\t" not in line:
+                    continue # partially written line
+                chunk_offset, files = line.rstrip("\n").split("\t")
+                offset = int(chunk_offset)
+                done.update(files.split("/"))
+        print(f"Resuming, skipping {len(done)} reports already parsed")
     skipped = []
-    for file in tqdm(os.listdir(reports_path)):
-        if file.endswith(".html"):
-            try:
-                with open(os.path.join(reports_path, file), 'r') as f:
-                    html = f.read()
-                    report_id = file.split('.')[0]
-                    report = parse_report(report_id, html)
-                    reports = pd.concat([reports, report])
-            except UnicodeDecodeError as e:
-                print(f"Error parsing {file}: {e}")
-                skipped.append(file)
+    with open(output, 'a+b') as out, open(progress_file, 'a' if done else 'w', encoding="utf-8") as progress_out:
+        # drop the rows of a chunk that was not finished
+        out.truncate(offset)
+        out.seek(offset)
+        write_header = offset == 0
+
+        progress = tqdm(unit="report")
+        chunk = []
+        if archive is not None:
+            entries = iter(_report_keys(archive))
+        else:
+            entries = (entry.path for entry in os.scandir(reports_path) if entry.name.endswith(".html"))
+        while True:
+            path = next(entries, None)
+            if path is not None:
+                if os.path.basename(path) in done:
+                    continue
+                chunk.append(path)
+                if len(chunk) < chunk_size:
+                    continue
+            if not chunk:
+                break
+
+            parsed, failed, _ = _parse_paths(chunk, parse_file, pool, workers, cache, progress,
+                                             archive.hash if archive is not None else None)
+            skipped.extend(failed)
+            reports = [parsed[path] for path in chunk if path in parsed]
+            if reports:
+                reports = pd.concat(reports)
+                if registry is not None:
+                    reports = registry.encode_reports(reports)
+                    registry.save() # before the chunk is recorded so a resumed run knows its ids
+                text = reports.to_csv(index=False, sep=";", header=write_header)
+                out.write(text.encode("utf-8"))
+                write_header = False
+            out.flush()
+            os.fsync(out.fileno())
+            progress_out.write(f"{out.tell()}\t{'/'.join(os.path.basename(path) for path in chunk)}\n")
+            progress_out.flush()
+            chunk = []
+        progress.close()
+    # The output is complete, a rerun starts over
+    os.remove(progress_file)
+    return skipped
+
+def parse_reports(reports_path: str, save: bool = False, workers: int = 1, cache: str = None, invalidate_cache: bool = False,
+                  save_format: str = "csv", backend: str = "bs4", stream: bool = False, chunk_size: int = 500,
+                  archive: str = None, question_ids: str = None):
+    """
+        Parses the given reports and returns a data frame with the parsed 
+        data. With workers other than 1 the reports are parsed in a process
+        pool of that many workers (None uses all cores), the result is the
+        same as the serial path. With a cache path only the reports that are
+        new or changed since the last run are parsed, invalidate_cache 
+        throws away the cached reports first. save_format is either "csv" 
+        (./data/report.csv) or "parquet" (./data/report.parquet) and 
+        backend is the html backend used (see html_backend.py).
+
+        With stream the reports are read lazily and the rows written to
+        ./data/report.csv in chunks of chunk_size reports so the memory use
+        does not grow with the number of reports, an interrupted run is 
+        resumed by the next one. Returns the path of the csv since the 
+        reports are never all in memory.
+
+        With an archive path the reports stored in the archive are parsed
+        instead of the files in reports_path. With a question_ids path the
+        category and question columns hold the ids of the lookup table at
+        the path (see questions.py) instead of the text, new variants are
+        added to the table.
+    """
+    if stream and save_format != "csv":
+        raise ValueError("Streaming only writes csv")
+    print("Parsing reports")
+    stage_start = time.perf_counter()
+    if cache is not None:
+        cache = ParseCache(cache, report_cols, PARSER_VERSION)
+        if invalidate_cache:
+            cache.clear()
+    registry = QuestionRegistry(question_ids) if question_ids is not None else None
+    pool = ProcessPoolExecutor(max_workers=workers) if workers != 1 else None
+    if archive is not None:
+        archive_path, archive = archive, Archive(archive)
+        parse_file = partial(_parse_archived_report, archive=archive_path if pool is not None else archive, backend=backend)
+    else:
+        parse_file = partial(_parse_report_file, backend=backend)
+
+    try:
+        if stream:
+            output = f"./data/report.csv"
+            skipped = _stream_reports(reports_path, output, parse_file, pool, workers, cache, chunk_size, archive, registry)
+        else:
+            if archive is not None:
+                # same order as the sorted file names
+                paths = sorted(_report_keys(archive), key=lambda key: key + ".html")
+                print(f"Found {len(paths)} reports in the archive")
+            else:
+                print(f"Found {len(os.listdir(reports_path))} directories")
+                files = sorted(file for file in os.listdir(reports_path) if file.endswith(".html"))
+                paths = [os.path.join(reports_path, file) for file in files]
+            with tqdm(total=len(paths)) as progress:
+                parsed, skipped, cached = _parse_paths(paths, parse_file, pool, workers, cache, progress,
+                                                       archive.hash if archive is not None else None)
+            if cache is not None:
+                print(f"Used {cached} cached reports, parsed {len(paths) - cached}")
+                cache.prune(paths)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        if cache is not None:
+            cache.close()
+        if archive is not None:
+            archive.close()
+
+    if skipped:
+        print(f"Skipped {len(skipped)} reports: {', '.join(skipped)}")
+    if stream:
+        METRICS.observe("stage_seconds", time.perf_counter() - stage_start, stage="parse_reports")
+        print("Done parsing reports")
+        return output
+
+    # Concatenate once at the end, concatenating per report is quadratic in the number of rows
+    parsed = [parsed[path] for path in paths if path in parsed]
+    reports = pd.concat(parsed) if parsed else pd.DataFrame(columns=report_cols)
+    if registry is not None:
+        reports = registry.encode_reports(reports)
+        registry.save()
     if save:
-        reports.to_csv(f"./data/report.csv", index=False, sep=";")
+        write_reports(reports, f"./data/report.{save_format}", save_format)
+    METRICS.observe("stage_seconds", time.perf_counter() - stage_start, stage="parse_reports")
     print("Done parsing reports")
+    return reports
+
+def parse_form_html(html: str, backend: str = "bs4"):
+    """
+        Parses the search form html and returns a dictionary of the input
+        fields with a data frame with the columns ['tag', 'name', 'sid']
+        for each of them.
+    """
+    trees = get_backend(backend).form_trees(html)
+    categories = {
+        "Programme": trees["treeCategories1"],
+        "Year": trees["treeCategories2"],
+        "LP": trees["treeCategories3"]
+        }
+    fields = {}
+
+    for category, lis in categories.items():
+        rows = []
+
+        for text, sid in lis:
+            if text != "Markera alla":
+                # Has to handle ZBASS- Tekniskt basår, TSLOG - Sjöfart och logistik, 2013/2014 or Läsperiod 1
+                tag = text
+                name = ""
+
+                if "-" in text: 
+                    keys = text.split("-")
+                    tag = keys[0].strip()
+                    name = keys[1].strip()
+                
+                rows.append([tag, name, sid])
+        fields[category] = pd.DataFrame(rows, columns=['tag', 'name', 'sid'], dtype=object)
+
+    return fields
 
-def parse_form(data_path: str):
+def parse_form(data_path: str, backend: str = "bs4"):
     """
         Parses the html and returns a dictionary of the input fields
         and their ids and returns a list of data frames with the 
         columns ['tag', 'name', 'sid'].
     """
     with open(os.path.join(data_path, "search.html"), 'r') as f:
-        soup = BeautifulSoup(f.read(), 'html.parser')
-        categories = {
-            "Programme": soup.find("div", {"id": "treeCategories1"}),
-            "Year": soup.find("div", {"id": "treeCategories2"}),
-            "LP": soup.find("div", {"id": "treeCategories3"})
-            }
-        fields = {}
-
-        for category, div in categories.items():
-            lis = div.find_all('li')
-            field = pd.DataFrame(columns=['tag', 'name', 'sid'])
-
-            for li in lis:
-                if li.text != "Markera alla":
-                    # Has to handle ZBASS- Tekniskt basår, TSLOG - Sjöfart och logistik, 2013/2014 or Läsperiod 1
-                    tag = li.text
-                    name = ""
-
-                    if "-" in li.text: 
-                        keys = li.text.split("-")
-                        tag = keys[0].strip()
-                        name = keys[1].strip()
-                    
-                    sid = li.find('input')['tag']
-                    # use concat to add a new row to the dataframe
-                    field = pd.concat([field, pd.DataFrame([[tag, name, sid]], columns=['tag', 'name', 'sid'])], ignore_index=True)
-            fields[category] = field
-
-        return fields
+        return parse_form_html(f.read(), backend)
 
 def update_form_mapping():
     fields = parse_form("./data/bp")
@@ -192,5 +480,6 @@ def update_form_mapping():
     for category, field in fields.items():
         field.to_csv(f"./data/mp/{category}.csv", index=False, sep=";")
 
-#update_searches()
-parse_reports("./data/reports", save=True)
\ No newline at end of file
+if __name__ == "__main__":
+    #update_searches()
+    parse_reports("./data/reports", save=True, cache="./data/report_cache.sqlite")
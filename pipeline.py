@@ -0,0 +1,280 @@
+"""
+pipeline.py - streaming scrape and parse pipeline
+
+The searches, report fetching and report parsing run as stages connected
+by bounded queues, so reports are fetched as soon as their search is
+parsed and parsed as soon as they are fetched.
+"""
+import os
+import time
+import queue
+import threading
+import pandas as pd
+
+import parser as p
+import scraper as s
+from metrics import METRICS
+from store import ResponseStore
+from ledger import JobLedger, IN_FLIGHT
+from timeseries import TimeSeries
+
+SEARCHES = [(s.BP_URL, "./data/bp/"), (s.MP_URL, "./data/mp/")]
+
+class Pipeline:
+    def __init__(self, output: str = "./data/report.csv", checkpoint: str = "./data/pipeline_checkpoint.txt",
+                 report_location: str = "./data/reports/", fetcher: s.Fetcher = None, store: ResponseStore = None,
+                 search_max_age: float = 0, report_max_age: float = None, queue_size: int = 64, timeseries: TimeSeries = None,
+                 ledger: JobLedger = None):
+        """
+            The parsed rows are appended to output as the reports are parsed
+            and the size of the output and the id of every finished report
+            to the checkpoint file, a rerun truncates the output to the last
+            finished report and skips the reports in the checkpoint. With a
+            store the saved reports fetched less than report_max_age seconds
+            ago (none if None) are read from disk, the others revalidated.
+            The queues hold at most queue_size items so a slow stage holds
+            back the others. With a timeseries the parsed reports and the
+            report maps are also ingested into it. With a ledger the report
+            fetches are jobs in it, failed fetches are retried with its
+            backoff and the fetches left by an interrupted run are resumed.
+        """
+        self.output = output
+        self.checkpoint = checkpoint
+        self.report_location = report_location
+        self.fetcher = fetcher if fetcher is not None else s.Fetcher()
+        self.store = store
+        self.search_max_age = search_max_age
+        self.report_max_age = report_max_age
+        self.timeseries = timeseries
+        self.ledger = ledger
+        self.report_queue = queue.Queue(maxsize=queue_size)
+        self.html_queue = queue.Queue(maxsize=queue_size)
+        self.offset, self.done = self.load_checkpoint()
+        self.stop = threading.Event() # set when a stage failed, the others wind down
+        self.error = None
+        self.stats = {"searches": 0, "reports": 0, "rows": 0, "resumed": len(self.done)}
+
+    def load_checkpoint(self):
+        """
+            Returns the size of the output after the last finished report
+            and the ids of the reports finished in earlier runs.
+        """
+        offset, done = 0, set()
+        if not os.path.isfile(self.checkpoint) or not os.path.isfile(self.output):
+            return offset, done
+        with open(self.checkpoint, 'r') as f:
+            for line in f:
+                if "\t" not in line:
+                    continue # partially written line
+                report_offset, report_id = line.rstrip("\n").split("\t")
+                offset = int(report_offset)
+                done.add(int(report_id))
+        return offset, done
+
+    def fail(self, error: Exception):
+        """
+            Records the first error of a stage and stops the others, run()
+            raises it once every stage has stopped.
+        """
+        if self.error is None:
+            self.error = error
+        self.stop.set()
+
+    def queue_reports(self, report_ids: list):
+        """
+            Queues the reports for the fetchers, with a ledger the reports
+            are added to it and the claimable jobs queued instead.
+        """
+        if self.ledger is None:
+            for report_id in report_ids:
+                self.report_queue.put(report_id) # blocks while the fetchers are behind
+            return
+        self.ledger.add("report", report_ids)
+        self.queue_claimed(self.ledger.claim("report", len(report_ids)))
+
+    def queue_claimed(self, keys: list):
+        """
+            Queues the claimed ledger jobs. A job whose report is already
+            in the checkpoint (the run stopped before it was marked done)
+            is marked done instead.
+        """
+        for key in keys:
+            if int(key) in self.done:
+                self.ledger.done("report", [key])
+            else:
+                self.report_queue.put(int(key))
+
+    def retry_failed(self):
+        """
+            Queues the failed fetches of the ledger again as they are due
+            until every job is done or out of attempts.
+        """
+        while not self.stop.is_set():
+            for keys in self.ledger.batches("report", self.fetcher.max_workers):
+                self.queue_claimed(keys)
+            if not self.ledger.counts("report").get(IN_FLIGHT):
+                return
+            time.sleep(0.1) # the queued fetches may still fail
+
+    def search_stage(self, searches: list):
+        """
+            Performs the searches, saves the report maps like parse_search
+            and queues every new report id as soon as its search is parsed.
+            The maps of a location are only saved if all its searches
+            succeeded, otherwise the maps of the last run are kept.
+        """
+        queued = set(self.done)
+        try:
+            for search_page, map_location in searches:
+                full_rows = []
+                failed = 0
+                for program, collector, filename in s.search_jobs(map_location, self.fetcher.session):
+                    if self.stop.is_set():
+                        return
+                    try:
+                        s.fetch_search(search_page, collector, filename, self.store, self.search_max_age)
+                        with open(filename, 'r') as f:
+                            rows = p.parse_search_html(program['tag'], f.read())
+                    except Exception as e:
+                        print(f"  Error searching {program['tag']}: {e}")
+                        METRICS.inc("search_failures_total")
+                        failed += 1
+                        continue
+                    self.stats["searches"] += 1
+                    full_rows.extend(rows)
+                    new = list(dict.fromkeys(report_id for _, _, report_id in rows if report_id is not None and report_id not in queued))
+                    queued.update(new)
+                    self.queue_reports(new)
+
+                if failed:
+                    print(f"  Keeping the report maps in {map_location}, {failed} searches failed")
+                    continue
+                report_map = pd.DataFrame(full_rows, columns=p.search_cols, dtype=object)
+                for programme, rows in report_map.groupby('programme', sort=False):
+                    rows.to_csv(map_location+"search/"+programme+"/report_map.csv", index=False, sep=";")
+                report_map.to_csv(map_location+"search/report_map.csv", index=False, sep=";")
+                if self.timeseries is not None:
+                    self.timeseries.add_programmes(report_map)
+            if self.ledger is not None:
+                self.retry_failed()
+        except Exception as e:
+            self.fail(e)
+        finally:
+            for _ in range(self.fetcher.max_workers):
+                self.report_queue.put(None)
+
+    def fetch_stage(self):
+        """
+            Fetches the queued reports, reports already saved are read from
+            disk unless a store is used and they are older than
+            report_max_age, then they are revalidated.
+        """
+        try:
+            while (report_id := self.report_queue.get()) is not None:
+                if self.stop.is_set():
+                    continue # drain the queue so the search stage isn't blocked
+                if report_id in self.done:
+                    continue # claimed again after its lease ran out
+                saved = f"{self.report_location}{report_id}.html"
+                url = self.fetcher.report_url.format(report_id=report_id)
+                try:
+                    if os.path.isfile(saved) and (self.store is None or self.store.is_fresh(url, self.report_max_age)):
+                        with open(saved, 'r', encoding="utf-8") as f:
+                            html = f.read()
+                    else:
+                        html = s.get_report(report_id, self.report_location, self.fetcher, self.store)
+                except Exception as e:
+                    print(f"  Error fetching {report_id}: {e}")
+                    METRICS.inc("fetch_failures_total")
+                    if self.ledger is not None:
+                        self.ledger.fail("report", report_id, repr(e))
+                    continue
+                if html is None:
+                    if self.ledger is not None:
+                        self.ledger.fail("report", report_id, "fetch failed")
+                    continue
+                # the ledger job is marked done by the parse stage once the report is checkpointed
+                self.html_queue.put((report_id, html)) # blocks while the parser is behind
+        finally:
+            self.html_queue.put(None)
+
+    def parse_stage(self):
+        """
+            Parses the fetched reports and appends the rows to the output
+            and the size of the output and the report id to the checkpoint,
+            like the streaming parse_reports. A rerun truncates the rows
+            of a report that was not checkpointed.
+        """
+        running = self.fetcher.max_workers
+        try:
+            with open(self.output, 'a+b') as out, open(self.checkpoint, 'a' if self.done else 'w') as checkpoint:
+                out.truncate(self.offset)
+                out.seek(self.offset)
+                write_header = self.offset == 0
+                while running:
+                    item = self.html_queue.get()
+                    if item is None:
+                        running -= 1
+                        continue
+                    report_id, html = item
+                    if report_id in self.done:
+                        continue # claimed again after its lease ran out
+                    start = time.perf_counter()
+                    try:
+                        report = p.parse_report(str(report_id), html)
+                    except Exception as e:
+                        print(f"  Error parsing {report_id}: {e}")
+                        METRICS.inc("parse_failures_total")
+                        if self.ledger is not None:
+                            self.ledger.done("report", [report_id]) # fetching it again won't help
+                        continue
+                    p.record_parse("report", time.perf_counter() - start, len(report))
+                    out.write(report.to_csv(index=False, sep=";", header=write_header).encode("utf-8"))
+                    write_header = False
+                    out.flush()
+                    os.fsync(out.fileno())
+                    if self.timeseries is not None:
+                        self.timeseries.ingest(report) # skips a report ingested before a crash
+                    # only checkpoint after the rows are written so a crash can't lose a report
+                    checkpoint.write(f"{out.tell()}\t{report_id}\n")
+                    checkpoint.flush()
+                    self.done.add(report_id)
+                    if self.ledger is not None:
+                        self.ledger.done("report", [report_id])
+                    self.stats["reports"] += 1
+                    self.stats["rows"] += len(report)
+        except Exception as e:
+            self.fail(e)
+            # drain the queue so the fetchers aren't blocked
+            while running:
+                if self.html_queue.get() is None:
+                    running -= 1
+
+    def run(self, searches: list = SEARCHES):
+        """
+            Runs all the stages until every search is done and every report
+            found is fetched and parsed. Raises the error of a failed stage
+            once the stages have stopped, the checkpoint is kept so the
+            next run resumes.
+        """
+        os.makedirs(self.report_location, exist_ok=True)
+        if self.done:
+            print(f"Resuming, skipping {len(self.done)} reports already parsed")
+        threads = [threading.Thread(target=self.search_stage, args=(searches,)), threading.Thread(target=self.parse_stage)]
+        threads += [threading.Thread(target=self.fetch_stage) for _ in range(self.fetcher.max_workers)]
+        with METRICS.timer("stage_seconds", stage="pipeline"):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        if self.error is not None:
+            raise self.error
+        # The run is complete, the next run is a new refresh
+        os.remove(self.checkpoint)
+        if self.ledger is not None:
+            for report_id, error in self.ledger.failed("report"):
+                print(f"Gave up on report {report_id}: {error}")
+            self.ledger.clear("report")
+        print(f"Done: {self.stats['searches']} searches, {self.stats['reports']} reports parsed "
+              f"({self.stats['resumed']} resumed), {self.stats['rows']} rows, {self.fetcher.stats['failed']} failed fetches")
+        return self.stats
@@ -0,0 +1,147 @@
+"""
+questions.py - canonical ids of the report categories and questions
+
+The same category or question is spelled differently across years, form
+versions and languages. The registry maps every variant to a stable
+integer id through a lookup table of normalized texts saved as
+./data/question_map.csv. Fuzzy matching (difflib) is only used when new
+variants are added to the table, looking up a variant is a dict lookup.
+"""
+import os
+import re
+import difflib
+import logging
+
+import numpy as np
+import pandas as pd
+
+# Header of the tables with a mean and median, in the english and swedish forms
+STAT_HEADERS = {"\xa0MeanMedian", "\xa0MedelvärdeMedian"}
+
+# The parsing stops after these categories, the rest are very detailed questions
+END_CATEGORIES = ["Overall impression", "Sammanfattande intryck", "Vad är Ditt sammanfattande intryck av kursen?", "What is your overall impression of the course?"]
+
+# Translations fuzzy matching can't find, the variants of every group share an id
+ALIASES = {
+    "category": [["Overall impression", "Sammanfattande intryck"],
+                 ["What is your overall impression of the course?", "Vad är Ditt sammanfattande intryck av kursen?"]],
+    "question": [],
+}
+
+KINDS = ["category", "question"]
+
+# Variants differing by one of these words say the opposite, they are never matched
+NEGATIONS = {"not", "no", "inte", "ej"}
+
+logger = logging.getLogger(__name__)
+
+_SPACE = re.compile(r"\s+")
+_EDGES = re.compile(r"^[\s\d.)]+|[\s?:.!]+$")
+_DIGITS = re.compile(r"\d+")
+_WORDS = re.compile(r"\w+")
+
+def normalize(text: str):
+    """
+        Returns the text without case, numbering, surrounding punctuation
+        and repeated whitespace.
+    """
+    text = _SPACE.sub(" ", str(text).replace("\xa0", " ")).casefold()
+    return _EDGES.sub("", text)
+
+class QuestionRegistry:
+    def __init__(self, path: str = "./data/question_map.csv", cutoff: float = 0.9):
+        """
+            Loads the lookup table at path if it exists. A new variant gets
+            the id of the known variant it is at least cutoff similar to
+            (difflib ratio) when added, otherwise a new id.
+        """
+        self.path = path
+        self.cutoff = cutoff
+        self.ids = {kind: {} for kind in KINDS} # normalized variant -> id
+        self.texts = {kind: {} for kind in KINDS} # id -> canonical text (the first variant seen)
+        if path is not None and os.path.isfile(path):
+            table = pd.read_csv(path, sep=";", keep_default_na=False)
+            for kind, variant, id, text in table[['kind', 'variant', 'id', 'text']].itertuples(index=False):
+                self.ids[kind][variant] = int(id)
+                self.texts[kind].setdefault(int(id), text)
+        else:
+            for kind, groups in ALIASES.items():
+                for group in groups:
+                    id = self._new_id(kind, group[0])
+                    for text in group:
+                        self.ids[kind][normalize(text)] = id
+
+    def _new_id(self, kind: str, text: str):
+        id = max(self.texts[kind], default=0) + 1
+        self.texts[kind][id] = text
+        return id
+
+    def lookup(self, text: str, kind: str = "question"):
+        """
+            Returns the id of the text or None if it is not in the table.
+        """
+        return self.ids[kind].get(normalize(text))
+
+    def text(self, id: int, kind: str = "question"):
+        """
+            Returns the canonical text of the id.
+        """
+        return self.texts[kind].get(id)
+
+    def add(self, texts, kind: str = "question"):
+        """
+            Adds the variants not in the table yet, either under the id of
+            the closest known variant or a new id. Variants whose numbers
+            differ ("Fråga 1" and "Fråga 2") or that differ by a negation
+            are never matched. Every fuzzy match is logged. Returns the
+            number of variants added.
+        """
+        known = self.ids[kind]
+        added = 0
+        for text in pd.unique(pd.Series(list(texts), dtype=object).dropna()):
+            variant = normalize(text)
+            if variant in known:
+                continue
+            digits = _DIGITS.findall(variant)
+            words = set(_WORDS.findall(variant))
+            matches = [match for match in difflib.get_close_matches(variant, list(known), n=3, cutoff=self.cutoff)
+                       if _DIGITS.findall(match) == digits and not (words ^ set(_WORDS.findall(match))) & NEGATIONS]
+            if matches:
+                known[variant] = known[matches[0]]
+                logger.info(f"Matched {kind} {text!r} to {matches[0]!r} (id {known[variant]})")
+            else:
+                known[variant] = self._new_id(kind, text)
+            added += 1
+        return added
+
+    def encode(self, values: pd.Series, kind: str = "question"):
+        """
+            Returns the ids of the texts in values (<NA> for unknown texts),
+            every distinct text is only normalized once.
+        """
+        codes, uniques = pd.factorize(values)
+        ids = np.array([self.ids[kind].get(normalize(text), -1) for text in uniques] + [-1], dtype=np.int64)
+        return pd.Series(ids[codes], index=values.index, dtype="Int64").mask(lambda s: s < 0)
+
+    def encode_reports(self, reports: pd.DataFrame, add: bool = True):
+        """
+            Returns the parsed reports with the ids in the category and
+            question columns, the new variants are added first unless add
+            is False.
+        """
+        reports = reports.copy()
+        for kind in KINDS:
+            if add:
+                self.add(reports[kind].unique(), kind)
+            reports[kind] = self.encode(reports[kind], kind)
+        return reports
+
+    def table(self):
+        """
+            Returns the lookup table as a data frame.
+        """
+        rows = [(kind, variant, id, self.texts[kind][id]) for kind in KINDS for variant, id in self.ids[kind].items()]
+        return pd.DataFrame(rows, columns=['kind', 'variant', 'id', 'text']).sort_values(['kind', 'id'], kind='stable')
+
+    def save(self, path: str = None):
+        self.table().to_csv(path or self.path, index=False, sep=";")
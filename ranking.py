@@ -0,0 +1,140 @@
+"""
+ranking.py - ranking courses by weighted survey scores
+"""
+import numpy as np
+import pandas as pd
+
+from storage import load_reports
+
+class Ranker:
+    def __init__(self, reports: pd.DataFrame, report_map: pd.DataFrame = None):
+        """
+            Builds the report x question matrix of mean values from the
+            parsed reports (report_cols in parser.py) and the indexes by
+            course_tag and programme (from the report_map.csv files) so
+            that ranking for a new set of weights is a few vector operations.
+        """
+        reports = reports.copy()
+        reports['mean'] = pd.to_numeric(reports['mean'].astype(str).str.replace(',', '.'), errors='coerce')
+        reports['report_id'] = pd.to_numeric(reports['report_id'], errors='coerce')
+        reports = reports.dropna(subset=['report_id'])
+        reports['report_id'] = reports['report_id'].astype(int)
+
+        # One row per report, one column per (category, question) pair that occurs, the
+        # reports without any mean keep an empty row
+        matrix = reports.groupby(['report_id', 'category', 'question'])['mean'].mean().unstack(['category', 'question'])
+        matrix = matrix.reindex(np.sort(reports['report_id'].unique()))
+        self.report_ids = matrix.index.to_numpy()
+        self.questions = matrix.columns.get_level_values('question').to_numpy()
+        column_categories = matrix.columns.get_level_values('category')
+        self.categories, self.column_category = np.unique(column_categories.to_numpy(), return_inverse=True)
+        values = matrix.to_numpy(dtype=float)
+        self.answered = ~np.isnan(values)
+        self.values = np.where(self.answered, values, 0.0)
+
+        # Per report info, in the same order as the matrix rows
+        info = reports.drop_duplicates('report_id').set_index('report_id').loc[self.report_ids]
+        self.info = info[['course_tag', 'course_name', 'period', 'reading_period', 'answers_count', 'respondents_count']].reset_index()
+        self.answers_count = pd.to_numeric(self.info['answers_count'], errors='coerce').fillna(0).to_numpy(dtype=float)
+        self.respondents_count = pd.to_numeric(self.info['respondents_count'], errors='coerce').fillna(0).to_numpy(dtype=float)
+
+        # Index of the course of every report
+        self.course_tags, self.report_course = np.unique(self.info['course_tag'].astype(str).to_numpy(), return_inverse=True)
+        course_names = self.info.drop_duplicates('course_tag').set_index('course_tag')['course_name']
+        self.course_names = course_names.reindex(self.course_tags).to_numpy()
+        self.course_index = {tag: i for i, tag in enumerate(self.course_tags)}
+        self.report_index = {report_id: i for i, report_id in enumerate(self.report_ids)}
+
+        self.programme_courses = {}
+        if report_map is not None:
+            for programme, tags in report_map.groupby('programme')['course_tag']:
+                self.programme_courses[programme] = np.array(sorted({self.course_index[tag] for tag in tags if tag in self.course_index}), dtype=int)
+
+    @classmethod
+    def load(cls, reports_path: str = "./data/report.csv", map_files: list = ["./data/bp/search/report_map.csv", "./data/mp/search/report_map.csv"]):
+        """
+            Creates a ranker from the saved reports (csv or parquet) and the
+            report maps.
+        """
+        report_map = pd.concat([pd.read_csv(f, sep=";") for f in map_files]) if map_files else None
+        return cls(load_reports(reports_path), report_map)
+
+    def _column_weights(self, weights: dict):
+        """
+            Returns the weight of every question column. The weights are keyed
+            by category or question (question weights take precedence), a
+            missing category has weight 1 unless weights is given with the
+            key "default".
+        """
+        if not weights:
+            return np.ones(len(self.questions))
+        default = weights.get("default", 1.0)
+        w = np.array([weights.get(category, default) for category in self.categories], dtype=float)[self.column_category]
+        for i, question in enumerate(self.questions):
+            if question in weights:
+                w[i] = weights[question]
+        return w
+
+    def report_scores(self, weights: dict = None):
+        """
+            Returns the weighted mean over the answered questions of every
+            report (nan if none of the weighted questions were answered).
+        """
+        w = self._column_weights(weights)
+        total = self.values @ w
+        weight = self.answered @ np.abs(w)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(weight > 0, total / weight, np.nan)
+
+    def course_scores(self, weights: dict = None, weight_by: str = "answers_count"):
+        """
+            Returns the score of every course as the mean of the scores of
+            its reports weighted by answers_count, respondents_count or
+            equally (None).
+        """
+        scores = self.report_scores(weights)
+        if weight_by is None:
+            report_weight = np.ones(len(scores))
+        elif weight_by == "answers_count":
+            report_weight = self.answers_count.copy()
+        elif weight_by == "respondents_count":
+            report_weight = self.respondents_count.copy()
+        else:
+            raise ValueError(f"Unknown weight_by {weight_by}")
+        report_weight[np.isnan(scores)] = 0
+        n = len(self.course_tags)
+        total = np.bincount(self.report_course, weights=np.nan_to_num(scores) * report_weight, minlength=n)
+        weight = np.bincount(self.report_course, weights=report_weight, minlength=n)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(weight > 0, total / weight, np.nan)
+
+    def top(self, k: int = 10, weights: dict = None, weight_by: str = "answers_count", programme: str = None, ascending: bool = False):
+        """
+            Returns a data frame of the k best (or worst with ascending)
+            courses, optionally only the courses of the given programme.
+        """
+        scores = self.course_scores(weights, weight_by)
+        candidates = self.programme_courses.get(programme, np.array([], dtype=int)) if programme is not None else np.arange(len(scores))
+        candidates = candidates[~np.isnan(scores[candidates])]
+        key = scores[candidates] if ascending else -scores[candidates]
+        if k < len(candidates):
+            # Only sort the k best instead of every course
+            part = np.argpartition(key, k)[:k]
+            candidates, key = candidates[part], key[part]
+        best = candidates[np.argsort(key, kind='stable')]
+        reports = np.bincount(self.report_course, minlength=len(self.course_tags))
+        return pd.DataFrame({
+            'course_tag': self.course_tags[best],
+            'course_name': self.course_names[best],
+            'score': scores[best],
+            'reports': reports[best],
+        })
+
+    def course(self, course_tag: str, weights: dict = None):
+        """
+            Returns the reports of the course with their scores.
+        """
+        if course_tag not in self.course_index:
+            return self.info.iloc[0:0].assign(score=[])
+        rows = np.flatnonzero(self.report_course == self.course_index[course_tag])
+        return self.info.iloc[rows].assign(score=self.report_scores(weights)[rows]).reset_index(drop=True)
@@ -1,12 +1,25 @@
 import os
+import time
+import logging
+import threading
 import requests
 import pandas as pd
 
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
 from bs4 import BeautifulSoup
+from tqdm import tqdm
+from metrics import METRICS
+from store import ResponseStore
+from archive import Archive, search_location
+from ledger import JobLedger
 
 BP_URL = 'https://course-eval.portal.chalmers.se/sr/ar/4257/sv'
 MP_URL = 'https://course-eval.portal.chalmers.se/sr/ar/4248/sv'
+REPORT_URL = 'https://course-eval.portal.chalmers.se/SR/Report/Token/{report_id}/0/0'
+
+logger = logging.getLogger(__name__)
 
 # Headers to use when fetching the reports and doing the POST requests to bypass the login
 HEADERS = {
@@ -28,28 +41,66 @@ HEADERS = {
     "Referrer-Policy": "strict-origin-when-cross-origin"
   }
 
+def timed_request(method, url: str, stage: str, **kwargs):
+    """
+        Sends the request with the given method (requests.get, session.post
+        ...) and records the latency, status code and bytes downloaded in 
+        the metrics under the stage.
+    """
+    start = time.perf_counter()
+    try:
+        r = method(url, **kwargs)
+    except requests.RequestException as e:
+        METRICS.inc("http_errors_total", stage=stage, error=type(e).__name__)
+        raise
+    finally:
+        METRICS.observe("http_request_seconds", time.perf_counter() - start, stage=stage)
+    METRICS.inc("http_responses_total", stage=stage, status=r.status_code)
+    METRICS.inc("http_bytes_total", len(r.content), stage=stage)
+    return r
+
+MAX_PROGRAMMES = 5 # Max programmes per search
+MAX_YEARS = 5 # Max years per search (only in bachelor programmes page)
+
+def new_session(pool_size: int = 10):
+    """
+        Returns a session with the headers and a connection pool for 
+        pool_size concurrent requests.
+    """
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
 class Collector:
-    def __init__(self, programmes: list, years: list, lps=['1049','1050','1051','1052']):
+    def __init__(self, programmes: list, years: list, lps=['1049','1050','1051','1052'], session: requests.Session = None):
         """
             programmes, years and lps has to be the correct id taken 
-            from mapper.py
+            from mapper.py. Collectors can share a session to reuse its
+            connections.
         """
-        self.session = requests.Session()
-        self.session.headers.update(HEADERS)
+        self.session = session if session is not None else new_session(1)
         self.programmes = list(map(lambda x: str(x), programmes)) # MAX 5
         self.years = list(map(lambda x: str(x), years)) # MAX 5 (only in bachelor programmes page)
         self.lps = list(map(lambda x: str(x), lps)) # LP1, LP2, LP3, LP4
 
-    def fetch(self, search_page: str):
+    def fetch(self, search_page: str, store: ResponseStore = None, conditional: bool = True):
         """
             Preforms a search on courses using the programmes, years and 
             lps as filters for the search through a POST request and 
-            returns the html in the response. 
+            returns the html in the response. With a store the validators
+            of the response are recorded and, if conditional, the request
+            is conditional on the validators of the last identical search
+            (only when that search is still saved). Raises
+            requests.HTTPError if the response is not a 200 (or a 304 to a
+            conditional request).
         """
         if not self.programmes or not self.years:
             print("No programmes or years selected")
             return
-        if len(self.programmes) > 5 or len(self.years) > 5:
+        if len(self.programmes) > MAX_PROGRAMMES or len(self.years) > MAX_YEARS:
             print("Too many programmes or years selected. The max is 5 each")
             return
 
@@ -57,58 +108,287 @@ class Collector:
             "hfCategory1="+"%2C".join(self.programmes),
             "hfCategory2="+"%2C".join(self.years),
             "hfCategory3="+"%2C".join(self.lps)])
-        self.data = self.session.post(search_page, data=data)
+        headers = store.headers(self.key(search_page)) if store is not None and conditional else {}
+        self.data = timed_request(self.session.post, search_page, "search", data=data, headers=headers)
+        if self.data.status_code not in ((200, 304) if headers else (200,)):
+            raise requests.HTTPError(f"Search failed with HTTP {self.data.status_code}", response=self.data)
+        if store is not None:
+            store.record(self.key(search_page), self.data)
         return self.data
 
+    def key(self, search_page: str):
+        """
+            Returns the key of the search in the response store.
+        """
+        return search_page + "#" + "|".join([",".join(self.programmes), ",".join(self.years), ",".join(self.lps)])
+
     def export_html(self, filename):
         with open(filename, 'w') as f:
             f.write(self.data.text)
             
-def get_report(report_id: int, save_location: str = None):
+class Fetcher:
+    def __init__(self, max_workers: int = 8, rate_limit: float = 10, retries: int = 3,
+                 backoff: float = 0.5, timeout: float = 30, report_url: str = REPORT_URL):
+        """
+            Fetches reports concurrently on a bounded thread pool sharing one 
+            pooled session. rate_limit is the max number of requests per 
+            second sent to a single host and report_url can be pointed at a 
+            local server serving canned reports.
+        """
+        self.max_workers = max_workers
+        self.rate_limit = rate_limit
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.report_url = report_url
+
+        self.session = new_session(max_workers)
+
+        self._lock = threading.Lock()
+        self._next_request = {} # host -> earliest time the next request may be sent
+        self.stats = {"fetched": 0, "unchanged": 0, "failed": 0, "retried": 0, "bytes": 0}
+
+    def _wait_for_host(self, url: str):
+        """
+            Blocks until a request to the host of the url is allowed by 
+            the rate limit.
+        """
+        if not self.rate_limit:
+            return
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_request.get(host, now))
+            self._next_request[host] = start + 1 / self.rate_limit
+        time.sleep(start - now)
+
+    def _count(self, key: str, value: int = 1):
+        with self._lock:
+            self.stats[key] += value
+
+    def get(self, url: str, headers: dict = None):
+        """
+            GETs the url, retrying with exponential backoff on 5xx responses,
+            timeouts and connection errors. Returns the response or None if 
+            all attempts failed.
+        """
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                self._count("retried")
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            self._wait_for_host(url)
+            try:
+                r = timed_request(self.session.get, url, "report", headers=headers, timeout=self.timeout)
+            except (requests.Timeout, requests.ConnectionError) as e:
+                error = e
+                continue
+            if r.status_code < 500:
+                return r
+            error = f"HTTP {r.status_code}"
+        logger.warning(f"Giving up on {url}: {error}")
+        return None
+
+    def fetch_reports(self, report_ids: list, save_location: str = None, store: ResponseStore = None, archive: Archive = None):
+        """
+            Fetches all the given reports and returns a dict of report id to
+            the report html (None for failed reports). Prints a summary of 
+            the throughput when done. With an archive the reports are saved
+            to it instead of the save location.
+        """
+        results = {}
+        with self._lock:
+            before = dict(self.stats)
+        start = time.monotonic()
+        with METRICS.timer("stage_seconds", stage="fetch_reports"), ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = {pool.submit(get_report, report_id, save_location, self, store, archive): report_id for report_id in report_ids}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                results[futures[future]] = future.result()
+        elapsed = time.monotonic() - start
+
+        # self.stats adds up every call, the summary is of this batch only
+        with self._lock:
+            batch = {key: self.stats[key] - before[key] for key in self.stats}
+        print(f"Fetched {batch['fetched']} reports, {batch['unchanged']} unchanged, {batch['failed']} failed, "
+              f"{batch['retried']} retries, {batch['bytes'] / 1e6:.1f} MB "
+              f"in {elapsed:.1f}s ({len(futures) / max(elapsed, 1e-9):.1f} reports/s)")
+        return results
+            
+def get_report(report_id: int, save_location: str = None, fetcher: Fetcher = None, store: ResponseStore = None,
+               archive: Archive = None):
     """
         Gets the report html from the given report id and returns the html
-        as a string.
-    """
-    url = f"https://course-eval.portal.chalmers.se/SR/Report/Token/{report_id}/0/0"
-    print(f"Getting report {report_id}")
-    r = requests.get(url, headers=HEADERS)
-    if r.status_code == 200:
-        print("  Fetched")
-        if save_location:
-            with open(f"{save_location}{report_id}.html", 'w', encoding="utf-8") as f:
+        as a string. If a fetcher is given its pooled session, rate limit 
+        and retries are used. With a store an already saved report is only
+        downloaded again if it changed upstream. With an archive the report
+        is saved to (and an unchanged one read from) the archive instead
+        of the save location.
+    """
+    url = fetcher.report_url.format(report_id=report_id) if fetcher is not None else REPORT_URL.format(report_id=report_id)
+    saved = f"{save_location}{report_id}.html" if save_location else None
+    headers = {}
+    if store is not None and is_saved(report_id, save_location, archive):
+        headers = store.headers(url)
+
+    if fetcher is not None:
+        r = fetcher.get(url, headers)
+    else:
+        logger.debug(f"Getting report {report_id}")
+        r = timed_request(requests.get, url, "report", headers={**HEADERS, **headers})
+    if r is not None and store is not None and r.status_code in (200, 304):
+        store.record(url, r)
+
+    if r is not None and r.status_code == 304:
+        if fetcher is not None:
+            fetcher._count("unchanged")
+        else:
+            logger.debug(f"Report {report_id} unchanged")
+        if archive is not None:
+            return archive.get(str(report_id))
+        with open(saved, 'r', encoding="utf-8") as f:
+            return f.read()
+    elif r is not None and r.status_code == 200:
+        if fetcher is not None:
+            fetcher._count("fetched")
+            fetcher._count("bytes", len(r.content))
+        else:
+            logger.debug(f"Fetched report {report_id}")
+        if archive is not None:
+            archive.put(str(report_id), r.text)
+        elif save_location:
+            with open(saved, 'w', encoding="utf-8") as f:
                 try:
                     f.write(r.text)
                 except UnicodeEncodeError as e:
-                    print(f"  Error: {e}")
+                    logger.warning(f"Error saving report {report_id}: {e}")
         return r.text
     else:
-        print("  Failed")
+        if fetcher is not None:
+            fetcher._count("failed")
+        else:
+            logger.debug(f"Failed to fetch report {report_id}")
         return None
 
-def update_courses(search_page: str, map_location: str):
+def is_saved(report_id: int, save_location: str = None, archive: Archive = None):
     """
-        Updates the mapping of course id to the program and the reports
-        and then saves the mapping in a csv file.
+        Returns True if the report is saved in the archive if given, 
+        otherwise in the save location.
+    """
+    if archive is not None:
+        return str(report_id) in archive
+    return bool(save_location) and os.path.isfile(f"{save_location}{report_id}.html")
+
+def search_key(filename: str):
+    """
+        Returns the archive key of the search saved to filename, the map
+        location, programme directory and page number ("bp/TKDAT/0").
+    """
+    directory, page = os.path.split(filename.replace("\\", "/"))
+    search_path, programme = os.path.split(directory)
+    return f"{search_location(search_path)}/{programme}/{os.path.splitext(page)[0]}"
+
+def plan_searches(programmes: list, years: list, max_programmes: int = MAX_PROGRAMMES, max_years: int = MAX_YEARS):
+    """
+        Packs the programmes and years into the fewest searches allowed by
+        the limits of the search page and returns a list of (programmes,
+        years) tuples, one per search.
+    """
+    if max_programmes > MAX_PROGRAMMES or max_years > MAX_YEARS:
+        raise ValueError(f"The max is {MAX_PROGRAMMES} programmes and {MAX_YEARS} years per search")
+    return [(programmes[i:i+max_programmes], years[j:j+max_years])
+            for i in range(0, len(programmes), max_programmes)
+            for j in range(0, len(years), max_years)]
+
+def search_jobs(map_location: str, session: requests.Session = None):
+    """
+        Yields the programme row, the collector and the file name of every
+        search needed to cover the programmes and years in the maps at 
+        the location.
     """
     lps = pd.read_csv(map_location+"LP_map.csv", sep=";")['sid'].tolist()
     programmes = pd.read_csv(map_location+"Programme_map.csv", sep=";")
     years = pd.read_csv(map_location+"Year_map.csv", sep=";")['sid'].tolist()
 
     for index, program in programmes.iterrows():
-        i = 0
-        print(f"Fetching {program['name']} ({i})... ({index+1}/{len(programmes)})")
-        for j in range(0, len(years), 5):
-            collector = Collector([program['sid']], years[j:j+5], lps)
-            location = map_location+"search/"+program['tag']+"/"
-            os.makedirs(location, exist_ok=True)
-            
-            collector.fetch(search_page)
-            collector.export_html(location + str(i) + ".html")
-            i += 1
+        print(f"Fetching {program['name']}... ({index+1}/{len(programmes)})")
+        location = map_location+"search/"+program['tag']+"/"
+        os.makedirs(location, exist_ok=True)
+        # One programme per search, the result rows don't say which of the programmes a course belongs to
+        for i, (_, search_years) in enumerate(plan_searches([program['sid']], years, max_programmes=1)):
+            yield program, Collector([program['sid']], search_years, lps, session), location + str(i) + ".html"
+
+def fetch_search(search_page: str, collector: Collector, filename: str, store: ResponseStore = None, max_age: float = 0,
+                 archive: Archive = None):
+    """
+        Performs the search and saves it to filename, or to the archive if
+        given. With a store, a saved search fetched less than max_age 
+        seconds ago is not fetched again and an unchanged one is not saved
+        again. Returns True if the search was fetched and saved, raises
+        requests.HTTPError if the search failed (nothing is saved).
+    """
+    saved = search_key(filename) in archive if archive is not None else os.path.isfile(filename)
+    if store is not None and saved:
+        if store.is_fresh(collector.key(search_page), max_age):
+            return False
+        collector.fetch(search_page, store)
+        if collector.data.status_code == 304:
+            return False
+    else:
+        # nothing saved to fall back on, a 304 would leave an empty page
+        collector.fetch(search_page, store, conditional=False)
+    if archive is not None:
+        archive.put(search_key(filename), collector.data.text)
+    else:
+        collector.export_html(filename)
+    return True
 
-def update_reports(map_file: str):
+def update_courses(search_page: str, map_location: str, store: ResponseStore = None, max_age: float = 0, workers: int = 4,
+                   archive: Archive = None, ledger: JobLedger = None):
     """
-        Fetches the reports found in the map and saves them.
+        Updates the mapping of course id to the program and the reports
+        and then saves the mapping in a csv file. The searches run on 
+        workers threads sharing one session. With a store, searches
+        that were fetched less than max_age seconds ago are skipped and
+        the others are only saved again if they changed. With an archive
+        the searches are saved to it instead of the search directories.
+        With a ledger the searches are drawn from it, the searches done 
+        in an interrupted run are skipped and the failed ones retried.
+    """
+    session = new_session(workers)
+    with METRICS.timer("stage_seconds", stage="update_courses"), ThreadPoolExecutor(max_workers=workers) as pool:
+        if ledger is None:
+            futures = [pool.submit(fetch_search, search_page, collector, filename, store, max_age, archive)
+                       for program, collector, filename in search_jobs(map_location, session)]
+            for future in as_completed(futures):
+                future.result()
+            return
+
+        stage = "search:" + map_location
+        collectors = {filename: collector for program, collector, filename in search_jobs(map_location, session)}
+        ledger.add(stage, list(collectors))
+        for filenames in ledger.batches(stage, workers * 4):
+            futures = {pool.submit(fetch_search, search_page, collectors[filename], filename, store, max_age, archive): filename
+                       for filename in filenames if filename in collectors}
+            ledger.done(stage, [filename for filename in filenames if filename not in collectors]) # no longer in the maps
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    ledger.done(stage, [futures[future]])
+                except Exception as e:
+                    logger.warning(f"Error searching {futures[future]}: {e}")
+                    ledger.fail(stage, futures[future], repr(e))
+
+def update_reports(map_file: str, save_location: str = "./reports/", fetcher: Fetcher = None,
+                   store: ResponseStore = None, max_age: float = None, archive: Archive = None, ledger: JobLedger = None):
+    """
+        Fetches the reports found in the map that are not already saved 
+        and saves them. The reports are fetched concurrently using the 
+        given fetcher (a default Fetcher if None). With a store the saved
+        reports older than max_age seconds (all if None) are refreshed with
+        conditional requests. With an archive the reports are saved to it
+        instead of the save location. With a ledger the reports are drawn
+        from it in batches and the failed fetches are retried (see 
+        ledger.py), so several processes can share the work and a rerun 
+        continues an interrupted one.
     """
     reports = pd.read_csv(map_file, sep=";")["report_id"]
     print(f"Found {len(reports)} reports!")
@@ -119,19 +399,40 @@ def update_reports(map_file: str):
     reports.drop_duplicates(inplace=True)
     reports.reset_index(drop=True, inplace=True)
 
-    print(f"Fetching {len(reports)} reports...")
-    for i, report_id in enumerate(reports):
-        report_id = int(report_id)
-        print(f"  Fetching {report_id} ({i+1}/{len(reports)})")
-        # check is report is already fetched
-        if not os.path.isfile(f"./reports/{report_id}.html"):
-            get_report(int(report_id), "./reports/")
-            print(f"    Saved to reports/{report_id}.html")
-
-#update_courses(BP_URL, "./data/bp/")
-#update_courses(MP_URL, "./data/mp/")
-update_reports("./data/bp/search/report_map.csv")
-update_reports("./data/mp/search/report_map.csv")
+    # check which reports are already fetched
+    report_ids = [int(report_id) for report_id in reports]
+    if store is None:
+        missing = [report_id for report_id in report_ids if not is_saved(report_id, save_location, archive)]
+    else:
+        report_url = fetcher.report_url if fetcher is not None else REPORT_URL
+        missing = [report_id for report_id in report_ids if not is_saved(report_id, save_location, archive)
+                   or not store.is_fresh(report_url.format(report_id=report_id), max_age)]
+    print(f"Skipping {len(report_ids)-len(missing)} already fetched reports.")
+
+    print(f"Fetching {len(missing)} reports...")
+    if archive is None:
+        os.makedirs(save_location, exist_ok=True)
+    if fetcher is None:
+        fetcher = Fetcher()
+    if ledger is None:
+        return fetcher.fetch_reports(missing, save_location, store, archive)
+
+    ledger.add("report", missing)
+    results = {}
+    for report_ids in ledger.batches("report", fetcher.max_workers * 64):
+        fetched = fetcher.fetch_reports([int(report_id) for report_id in report_ids], save_location, store, archive)
+        ledger.done("report", [report_id for report_id, html in fetched.items() if html is not None])
+        for report_id, html in fetched.items():
+            if html is None:
+                ledger.fail("report", report_id, "fetch failed")
+        results.update(fetched)
+    return results
+
+if __name__ == "__main__":
+    #update_courses(BP_URL, "./data/bp/")
+    #update_courses(MP_URL, "./data/mp/")
+    update_reports("./data/bp/search/report_map.csv")
+    update_reports("./data/mp/search/report_map.csv")
 
 
 #df = pd.read_csv(data_path+'data.csv')
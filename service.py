@@ -0,0 +1,301 @@
+"""
+service.py - asynchronous http query service over the parsed reports
+
+Loads the parsed reports once into memory resident indexes (the Ranker
+matrix and sorted course tag/name lists for prefix search) and answers
+json queries from them. Responses are kept in an LRU cache that belongs
+to the loaded indexes, when a new parse is saved the indexes and the cache
+are rebuilt in the background and swapped in.
+
+    GET /course/<course_tag>?weights={...}      reports and score of a course
+    GET /search?q=<prefix>&limit=20             courses by tag or name prefix
+    GET /rank?k=10&programme=&weight_by=answers_count&ascending=0&weights={...}
+    GET /health                                 size of the indexes and the cache
+
+    python service.py --port 8080
+"""
+import os
+import json
+import time
+import asyncio
+import bisect
+import logging
+import argparse
+import threading
+from functools import lru_cache
+from urllib.parse import urlsplit, parse_qsl, unquote
+
+import pandas as pd
+
+from ranking import Ranker
+from metrics import METRICS
+from storage import load_reports
+
+logger = logging.getLogger(__name__)
+
+MAP_FILES = ["./data/bp/search/report_map.csv", "./data/mp/search/report_map.csv"]
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+class QueryError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+def _records(frame: pd.DataFrame):
+    # to_json turns nan into null and numpy scalars into plain numbers
+    return json.loads(frame.to_json(orient="records"))
+
+def _weights(query: dict):
+    if "weights" not in query:
+        return None
+    try:
+        weights = json.loads(query["weights"])
+    except ValueError as e:
+        raise QueryError(400, f"weights is not valid json: {e}")
+    if not isinstance(weights, dict):
+        raise QueryError(400, "weights must be a json object of category or question to weight")
+    for key, weight in weights.items():
+        if isinstance(weight, bool) or not isinstance(weight, (int, float)):
+            raise QueryError(400, f"weight of {key} must be a number")
+    return weights
+
+def _int(query: dict, name: str, default: int):
+    try:
+        value = int(query.get(name, default))
+    except ValueError:
+        raise QueryError(400, f"{name} must be an integer")
+    if value < 0:
+        raise QueryError(400, f"{name} must not be negative")
+    return value
+
+class Index:
+    def __init__(self, reports: pd.DataFrame, report_map: pd.DataFrame = None, cache_size: int = 4096):
+        """
+            Builds the indexes over the parsed reports (report_cols in
+            parser.py). Every index has its own LRU cache of responses so
+            a reload never serves responses of the old data.
+        """
+        self.ranker = Ranker(reports, report_map)
+        self.loaded = time.time()
+        tags = self.ranker.course_tags
+        names = self.ranker.course_names
+        # course_tags are sorted, the names are sorted separately for the name prefix search
+        self.tags = [str(tag).lower() for tag in tags]
+        name_order = sorted(range(len(tags)), key=lambda i: str(names[i]).lower())
+        self.names = [str(names[i]).lower() for i in name_order]
+        self.name_courses = name_order
+        self.query = lru_cache(maxsize=cache_size)(self._query)
+
+    def _query(self, route: str, params: tuple):
+        """
+            Returns the json body of the query, cached by query().
+        """
+        query = dict(params)
+        if route == "course":
+            return json.dumps(self.course(query["course_tag"], _weights(query)))
+        if route == "search":
+            return json.dumps(self.search(query.get("q", ""), _int(query, "limit", 20)))
+        if route == "rank":
+            weight_by = query.get("weight_by", "answers_count")
+            if weight_by not in ("answers_count", "respondents_count", "none"):
+                raise QueryError(400, f"Unknown weight_by {weight_by}")
+            ranking = self.ranker.top(_int(query, "k", 10), _weights(query), None if weight_by == "none" else weight_by,
+                                      query.get("programme"), query.get("ascending", "0") in ("1", "true"))
+            return json.dumps(_records(ranking))
+        raise QueryError(404, f"Unknown route {route}")
+
+    def course(self, course_tag: str, weights: dict = None):
+        if course_tag not in self.ranker.course_index:
+            raise QueryError(404, f"Unknown course {course_tag}")
+        i = self.ranker.course_index[course_tag]
+        score = self.ranker.course_scores(weights)[i]
+        return {
+            "course_tag": course_tag,
+            "course_name": self.ranker.course_names[i],
+            "score": None if pd.isna(score) else float(score),
+            "reports": _records(self.ranker.course(course_tag, weights)),
+        }
+
+    @staticmethod
+    def _prefixed(keys: list, prefix: str):
+        start = bisect.bisect_left(keys, prefix)
+        end = bisect.bisect_left(keys, prefix + "\uffff")
+        return range(start, end)
+
+    def search(self, prefix: str, limit: int = 20):
+        """
+            Returns the courses whose tag or name starts with the prefix
+            (case insensitive), the tag matches first.
+        """
+        prefix = prefix.lower()
+        found = list(self._prefixed(self.tags, prefix))
+        seen = set(found)
+        for i in self._prefixed(self.names, prefix):
+            if self.name_courses[i] not in seen:
+                found.append(self.name_courses[i])
+                seen.add(self.name_courses[i])
+        return [{"course_tag": self.ranker.course_tags[i], "course_name": self.ranker.course_names[i]} for i in found[:limit]]
+
+    def health(self):
+        return {
+            "courses": len(self.ranker.course_tags),
+            "reports": len(self.ranker.report_ids),
+            "loaded": self.loaded,
+            "cache": self.query.cache_info()._asdict(),
+        }
+
+class QueryService:
+    def __init__(self, reports_path: str = "./data/report.csv", map_files: list = MAP_FILES, host: str = "127.0.0.1",
+                 port: int = 8080, cache_size: int = 4096, reload_interval: float = 5):
+        """
+            Serves the reports at reports_path (csv or parquet) on host and
+            port (0 picks a free port, see self.port once ready is set). The
+            reports are checked for a new parse every reload_interval
+            seconds.
+        """
+        self.reports_path = reports_path
+        self.map_files = map_files
+        self.host = host
+        self.port = port
+        self.cache_size = cache_size
+        self.reload_interval = reload_interval
+        self.index = None
+        self.signature = None
+        self.ready = threading.Event()
+
+    def _signature(self):
+        """
+            Returns the modification times of the saved reports, None while
+            a streaming parse is writing them.
+        """
+        if os.path.exists(self.reports_path + ".progress") or not os.path.exists(self.reports_path):
+            return None
+        if os.path.isfile(self.reports_path):
+            return os.stat(self.reports_path).st_mtime_ns
+        return max((os.stat(os.path.join(root, f)).st_mtime_ns for root, _, files in os.walk(self.reports_path) for f in files), default=None)
+
+    def load(self):
+        """
+            Builds a new index from the saved reports and report maps.
+        """
+        signature = self._signature()
+        maps = [pd.read_csv(f, sep=";") for f in self.map_files if os.path.isfile(f)]
+        index = Index(load_reports(self.reports_path), pd.concat(maps) if maps else None, self.cache_size)
+        return signature, index
+
+    async def watch(self):
+        """
+            Swaps in a new index when the saved reports change.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            signature = self._signature()
+            if signature is None or signature == self.signature:
+                continue
+            try:
+                # built off the event loop so the queries keep being answered
+                self.signature, self.index = await loop.run_in_executor(None, self.load)
+                METRICS.inc("service_reloads_total")
+                logger.info(f"Reloaded {self.reports_path}")
+            except Exception as e:
+                logger.warning(f"Error reloading {self.reports_path}: {e}")
+                self.signature = signature # don't retry the same broken parse
+
+    def respond(self, method: str, target: str):
+        """
+            Returns the status and json body of the request.
+        """
+        if method != "GET":
+            return 405, json.dumps({"error": f"{method} is not allowed"})
+        url = urlsplit(target)
+        parts = [unquote(part) for part in url.path.strip("/").split("/")]
+        params = parse_qsl(url.query)
+        index = self.index
+        try:
+            if parts == ["health"]:
+                return 200, json.dumps(index.health())
+            if len(parts) == 2 and parts[0] == "course":
+                params.append(("course_tag", parts[1]))
+                route = "course"
+            elif len(parts) == 1 and parts[0] in ("search", "rank"):
+                route = parts[0]
+            else:
+                raise QueryError(404, f"Unknown path {url.path}")
+            return 200, index.query(route, tuple(sorted(params)))
+        except QueryError as e:
+            return e.status, json.dumps({"error": str(e)})
+        except Exception:
+            # a bug in a query must not take down the connection, the details are only logged
+            logger.exception(f"Error answering {target}")
+            return 500, json.dumps({"error": "Internal server error"})
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+            Answers the requests of one connection, kept alive unless the
+            client asks to close it.
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    break
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                if int(headers.get("content-length", 0)):
+                    await reader.readexactly(int(headers["content-length"]))
+
+                start = time.perf_counter()
+                status, body = self.respond(method, target)
+                METRICS.observe("query_seconds", time.perf_counter() - start)
+                METRICS.inc("queries_total", status=status)
+
+                keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                body = body.encode("utf-8")
+                writer.write((f"{version} {status} {STATUS_TEXT[status]}\r\nContent-Type: application/json\r\n"
+                              f"Content-Length: {len(body)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode("latin-1") + body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        """
+            Loads the reports and serves until cancelled.
+        """
+        loop = asyncio.get_running_loop()
+        self.signature, self.index = await loop.run_in_executor(None, self.load)
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = server.sockets[0].getsockname()[1]
+        print(f"Serving {self.reports_path} on http://{self.host}:{self.port}")
+        self.ready.set()
+        watcher = asyncio.create_task(self.watch())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            watcher.cancel()
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Serves queries over the parsed reports")
+    arg_parser.add_argument("--reports", default="./data/report.csv", help="parsed reports, csv or parquet")
+    arg_parser.add_argument("--host", default="127.0.0.1")
+    arg_parser.add_argument("--port", type=int, default=8080)
+    arg_parser.add_argument("--cache-size", type=int, default=4096, help="responses kept in the LRU cache")
+    arg_parser.add_argument("--reload-interval", type=float, default=5, help="seconds between checks for a new parse")
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    service = QueryService(args.reports, MAP_FILES, args.host, args.port, args.cache_size, args.reload_interval)
+    try:
+        asyncio.run(service.serve())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,79 @@
+"""
+storage.py - writing and loading the parsed reports as csv or parquet
+"""
+import os
+import pandas as pd
+
+# Columns repeated in every row of a report, stored dictionary encoded in parquet
+CATEGORICAL_COLS = ['course_tag', 'course_name', 'reading_period', 'category', 'question']
+NUMERIC_COLS = ['mean', 'median']
+INTEGER_COLS = ['report_id', 'answers_count', 'respondents_count']
+
+def typed_reports(reports: pd.DataFrame):
+    """
+        Returns a copy of the parsed reports with numeric mean and median
+        (nan when missing), integer ids and counts and categorical columns
+        for the repeated strings.
+    """
+    reports = reports.copy()
+    for col in NUMERIC_COLS:
+        # Swedish reports may use decimal commas
+        reports[col] = pd.to_numeric(reports[col].astype(str).str.replace(',', '.'), errors='coerce').astype(float)
+    for col in INTEGER_COLS:
+        reports[col] = pd.to_numeric(reports[col], errors='coerce').astype('Int64')
+    for col in CATEGORICAL_COLS:
+        reports[col] = reports[col].astype('category')
+    reports['period'] = reports['period'].astype(str)
+    return reports.reset_index(drop=True)
+
+def write_reports(reports: pd.DataFrame, path: str, format: str = "csv"):
+    """
+        Writes the parsed reports to path either as the semicolon separated
+        csv or as a parquet dataset partitioned by period.
+    """
+    if format == "csv":
+        reports.to_csv(path, index=False, sep=";")
+    elif format == "parquet":
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+
+        table = pa.Table.from_pandas(typed_reports(reports), preserve_index=False)
+        os.makedirs(path, exist_ok=True)
+        # hive partitioning uri encodes the / in the periods (2013/2014)
+        ds.write_dataset(table, path, format="parquet", partitioning=["period"], partitioning_flavor="hive",
+                         existing_data_behavior="delete_matching")
+    else:
+        raise ValueError(f"Unknown format {format}")
+
+def load_reports(path: str, course_tag=None, period=None, category=None, columns: list = None):
+    """
+        Loads the parsed reports from a csv file or parquet dataset. The
+        course_tag, period and category filters take a value or a list of
+        values and are pushed down to the parquet reader so only the
+        matching partitions and row groups are read.
+    """
+    filters = {'course_tag': course_tag, 'period': period, 'category': category}
+    filters = {col: value if isinstance(value, (list, tuple, set)) else [value]
+               for col, value in filters.items() if value is not None}
+
+    if os.path.isfile(path):
+        reports = pd.read_csv(path, sep=";", usecols=columns)
+        for col, values in filters.items():
+            reports = reports[reports[col].isin(values)]
+        return reports.reset_index(drop=True)
+
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(path, format="parquet", partitioning="hive")
+    expression = None
+    for col, values in filters.items():
+        condition = ds.field(col).isin(list(values))
+        expression = condition if expression is None else expression & condition
+    reports = dataset.to_table(columns=columns, filter=expression).to_pandas()
+    if 'period' in reports:
+        reports['period'] = reports['period'].astype(str)
+    if columns is None:
+        # the partition column is appended last, restore the order the reports were written in
+        order = [col['name'] for col in dataset.schema.pandas_metadata['columns'] if col['name'] in reports]
+        reports = reports[order]
+    return reports
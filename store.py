@@ -0,0 +1,63 @@
+"""
+store.py - validators and fetch times of the responses fetched by the scraper
+"""
+import time
+import sqlite3
+import threading
+
+class ResponseStore:
+    def __init__(self, path: str):
+        """
+            Opens (or creates) the sqlite store at path. The store is keyed
+            by the url for GET requests and the url and payload for searches
+            and can be shared between the fetcher threads.
+        """
+        self.con = sqlite3.connect(path, check_same_thread=False)
+        self.con.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, fetched_at REAL)")
+        self.con.commit()
+        self._lock = threading.Lock()
+
+    def _get(self, key: str):
+        with self._lock:
+            return self.con.execute("SELECT etag, last_modified, fetched_at FROM responses WHERE key = ?", (key,)).fetchone()
+
+    def headers(self, key: str):
+        """
+            Returns the conditional request headers for the key, empty if
+            nothing has been stored for it.
+        """
+        row = self._get(key)
+        headers = {}
+        if row is not None:
+            etag, last_modified, _ = row
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def is_fresh(self, key: str, max_age: float):
+        """
+            Returns True if the key was fetched less than max_age seconds ago.
+        """
+        row = self._get(key)
+        return row is not None and max_age is not None and time.time() - row[2] < max_age
+
+    def record(self, key: str, response):
+        """
+            Stores the validators of the response and the fetch time. On a
+            304 the old validators are kept unless new ones were sent.
+        """
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        with self._lock:
+            if response.status_code == 304:
+                self.con.execute("UPDATE responses SET etag = COALESCE(?, etag), last_modified = COALESCE(?, last_modified), fetched_at = ? WHERE key = ?",
+                                 (etag, last_modified, time.time(), key))
+            else:
+                self.con.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, etag, last_modified, time.time()))
+            self.con.commit()
+
+    def close(self):
+        with self._lock:
+            self.con.close()
@@ -1,3 +1,14 @@
+import re
+
+import pandas as pd
+
+# "<tag> <name> <YYYY/YYYY> <LPx-LPy>" optionally followed by a note like "(Kompletterande enkät)"
+COURSE_TEXT = re.compile(r"(?P<course_tag>\S+) (?P<course_name>.*) (?P<period>\d{4}/\d{4}) (?P<reading_period>LP\d-LP\d)(?: \((?P<note>.*)\))?")
+# Same with any whitespace between the parts, only tried when the first doesn't match
+_COURSE_TEXT_SPACES = re.compile(COURSE_TEXT.pattern.replace(" ", r"\s+"), re.S)
+
+course_cols = ['course_tag', 'course_name', 'period', 'reading_period', 'note', 'parsed']
+
 def parse_course_text(course_text: str):
     """
         Parses the given course text and returns a tuple containing the course 
@@ -11,4 +22,35 @@ def parse_course_text(course_text: str):
     reading_period = words[-1]
     return course_tag, course_name, period, reading_period
 
-assert parse_course_text(" ATH100 Arkitektur och stadsbyggande: En kulturhistorisk orientering 2013/2014 LP3-LP4  ") == ('ATH100', 'Arkitektur och stadsbyggande: En kulturhistorisk orientering', '2013/2014', 'LP3-LP4')
\ No newline at end of file
+def match_course_text(course_text: str):
+    """
+        Returns the course tag, name, period, reading period, note (None if
+        there is none) and True if the course text is in the expected
+        format. Otherwise only the course tag (the first word) is returned
+        with the rest None and False.
+    """
+    text = course_text.strip() if isinstance(course_text, str) else ""
+    match = COURSE_TEXT.fullmatch(text) or _COURSE_TEXT_SPACES.fullmatch(text)
+    if match is None:
+        words = text.split(maxsplit=1)
+        return words[0] if words else None, None, None, None, None, False
+    return match.group('course_tag', 'course_name', 'period', 'reading_period', 'note') + (True,)
+
+def parse_course_texts(course_texts):
+    """
+        Parses a column (or list) of course texts at once and returns a data
+        frame of course_cols with the same index, the rows that are not in
+        the expected format have parsed False (see match_course_text).
+        Every distinct text is only matched once.
+    """
+    texts = course_texts if isinstance(course_texts, pd.Series) else pd.Series(list(course_texts), dtype=object)
+    codes, uniques = pd.factorize(texts)
+    # the last row is for the missing texts (code -1)
+    parsed = pd.DataFrame([match_course_text(text) for text in uniques] + [(None, None, None, None, None, False)],
+                          columns=course_cols, dtype=object)
+    parsed = parsed.iloc[codes].set_index(texts.index)
+    parsed['parsed'] = parsed['parsed'].astype(bool)
+    return parsed
+
+assert parse_course_text(" ATH100 Arkitektur och stadsbyggande: En kulturhistorisk orientering 2013/2014 LP3-LP4  ") == ('ATH100', 'Arkitektur och stadsbyggande: En kulturhistorisk orientering', '2013/2014', 'LP3-LP4')
+assert match_course_text(" ATH100 Arkitektur och stadsbyggande: En kulturhistorisk orientering 2014/2015 LP3-LP4 (Kompletterande enkät)") == ('ATH100', 'Arkitektur och stadsbyggande: En kulturhistorisk orientering', '2014/2015', 'LP3-LP4', 'Kompletterande enkät', True)
@@ -0,0 +1,205 @@
+"""
+timeseries.py - persistent multi-year store of the parsed reports
+
+Every question row is kept in a sqlite table clustered on (course_tag,
+period, reading_period, question) so the history of a course is a range
+scan. Reports are ingested as deltas, a report already in the store with
+the same rows is skipped and a changed one replaces its rows. The mean of
+every course and reading period is kept up to date on ingestion so trend
+queries read the aggregates instead of the rows.
+"""
+import time
+import hashlib
+import sqlite3
+import threading
+
+import pandas as pd
+
+import parser as p
+from storage import typed_reports
+
+class TimeSeries:
+    def __init__(self, path: str):
+        """
+            Opens (or creates) the store at path.
+        """
+        self.con = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.con.executescript("""
+            CREATE TABLE IF NOT EXISTS evaluations (
+                course_tag TEXT, period TEXT, reading_period TEXT, question TEXT, report_id INTEGER,
+                category TEXT, mean REAL, median REAL, answers_count INTEGER, respondents_count INTEGER,
+                PRIMARY KEY (course_tag, period, reading_period, question, report_id)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS evaluations_report ON evaluations (report_id);
+            CREATE TABLE IF NOT EXISTS reports (report_id INTEGER PRIMARY KEY, course_tag TEXT, hash TEXT, ingested_at REAL);
+            CREATE TABLE IF NOT EXISTS course_periods (
+                course_tag TEXT, period TEXT, reading_period TEXT,
+                reports INTEGER, answers INTEGER, questions INTEGER, mean_sum REAL, weighted_sum REAL, weight REAL,
+                PRIMARY KEY (course_tag, period, reading_period)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS programmes (programme TEXT, course_tag TEXT, PRIMARY KEY (programme, course_tag)) WITHOUT ROWID;
+        """)
+        self.con.commit()
+
+    @staticmethod
+    def _aggregate(report: pd.DataFrame):
+        """
+            Returns the contribution of one typed report to its course and
+            reading period, the means are weighted by the answers.
+        """
+        answered = report['mean'].dropna()
+        answers = report['answers_count'].iloc[0]
+        answers = 0 if pd.isna(answers) else int(answers)
+        return (1, answers, len(answered), float(answered.sum()), float(answered.sum() * answers), float(len(answered) * answers))
+
+    def _add(self, key: tuple, contribution: tuple, sign: int = 1):
+        reports, answers, questions, mean_sum, weighted_sum, weight = (sign * value for value in contribution)
+        self.con.execute("""
+            INSERT INTO course_periods VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (course_tag, period, reading_period) DO UPDATE SET
+                reports = reports + excluded.reports, answers = answers + excluded.answers,
+                questions = questions + excluded.questions, mean_sum = mean_sum + excluded.mean_sum,
+                weighted_sum = weighted_sum + excluded.weighted_sum, weight = weight + excluded.weight
+        """, (*key, reports, answers, questions, mean_sum, weighted_sum, weight))
+
+    def _remove(self, report_id: int):
+        """
+            Removes the rows of an ingested report and its contribution to
+            the aggregates.
+        """
+        rows = self.con.execute("SELECT course_tag, period, reading_period, question, category, mean, median, answers_count, respondents_count "
+                                "FROM evaluations WHERE report_id = ?", (report_id,)).fetchall()
+        old = pd.DataFrame(rows, columns=['course_tag', 'period', 'reading_period', 'question', 'category', 'mean', 'median',
+                                          'answers_count', 'respondents_count'])
+        old['mean'] = pd.to_numeric(old['mean'])
+        for key, report in old.groupby(['course_tag', 'period', 'reading_period']):
+            self._add(key, self._aggregate(report), -1)
+        self.con.execute("DELETE FROM evaluations WHERE report_id = ?", (report_id,))
+
+    def ingest(self, reports: pd.DataFrame):
+        """
+            Ingests the parsed reports (report_cols in parser.py), reports
+            already in the store are skipped unless their rows changed.
+            Returns the number of new or changed reports.
+        """
+        reports = typed_reports(reports[p.report_cols].dropna(subset=['report_id']))
+        for col in ['course_tag', 'reading_period', 'category', 'question']:
+            reports[col] = reports[col].astype(str)
+        ingested = 0
+        with self._lock:
+            known = dict(self.con.execute("SELECT report_id, hash FROM reports").fetchall())
+            for report_id, report in reports.groupby('report_id', sort=False):
+                report_id = int(report_id)
+                digest = hashlib.sha1(report.to_csv(index=False).encode("utf-8")).hexdigest()
+                if known.get(report_id) == digest:
+                    continue
+                if report_id in known:
+                    self._remove(report_id)
+                # A report asking the same question twice keeps the first, the aggregates only
+                # count the stored rows so _remove() subtracts exactly what was added
+                report = report.drop_duplicates(['course_tag', 'period', 'reading_period', 'question'])
+                first = report.iloc[0]
+                rows = report[['course_tag', 'period', 'reading_period', 'question', 'report_id', 'category', 'mean', 'median',
+                               'answers_count', 'respondents_count']].astype(object).where(report.notna(), None)
+                self.con.executemany("INSERT INTO evaluations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                     rows.itertuples(index=False, name=None))
+                self._add((first['course_tag'], first['period'], first['reading_period']), self._aggregate(report))
+                self.con.execute("INSERT OR REPLACE INTO reports VALUES (?, ?, ?, ?)", (report_id, first['course_tag'], digest, time.time()))
+                ingested += 1
+            self.con.commit()
+        return ingested
+
+    def ingest_html(self, reports: dict, backend: str = "bs4"):
+        """
+            Parses and ingests the {report_id: html} returned by
+            scraper.update_reports, failed fetches (None) are skipped.
+            Returns the number of new or changed reports.
+        """
+        parsed = []
+        for report_id, html in reports.items():
+            if html is None:
+                continue
+            try:
+                parsed.append(p.parse_report(str(report_id), html, backend))
+            except Exception as e:
+                print(f"  Error parsing {report_id}: {e}")
+        if not parsed:
+            return 0
+        return self.ingest(pd.concat(parsed))
+
+    def add_programmes(self, report_map: pd.DataFrame):
+        """
+            Records the courses of every programme from a report map
+            (search_cols in parser.py) for the per programme queries.
+        """
+        pairs = report_map[['programme', 'course_tag']].dropna().drop_duplicates()
+        with self._lock:
+            self.con.executemany("INSERT OR IGNORE INTO programmes VALUES (?, ?)", pairs.itertuples(index=False, name=None))
+            self.con.commit()
+
+    def _query(self, sql: str, params: tuple = ()):
+        with self._lock:
+            cursor = self.con.execute(sql, params)
+            return pd.DataFrame(cursor.fetchall(), columns=[col[0] for col in cursor.description])
+
+    # Mean of the aggregated rows, weighted by the answers when there are any
+    _MEAN = "CASE WHEN SUM(weight) > 0 THEN SUM(weighted_sum) / SUM(weight) ELSE SUM(mean_sum) / NULLIF(SUM(questions), 0) END"
+
+    def course_trend(self, course_tag: str, by_reading_period: bool = False):
+        """
+            Returns the mean of the course per period (and reading period)
+            with the number of reports and answers, oldest first.
+        """
+        group = "period, reading_period" if by_reading_period else "period"
+        return self._query(f"SELECT {group}, {self._MEAN} AS mean, SUM(reports) AS reports, SUM(answers) AS answers "
+                           f"FROM course_periods WHERE course_tag = ? GROUP BY {group} HAVING SUM(questions) > 0 ORDER BY {group}",
+                           (course_tag,))
+
+    def question_trend(self, course_tag: str, question: str = None):
+        """
+            Returns the mean and median of the questions of the course (or
+            only the given question) per period and reading period.
+        """
+        sql = ("SELECT period, reading_period, category, question, report_id, mean, median, answers_count "
+               "FROM evaluations WHERE course_tag = ?")
+        params = (course_tag,)
+        if question is not None:
+            sql += " AND question = ?"
+            params += (question,)
+        return self._query(sql + " ORDER BY period, reading_period, question", params)
+
+    def improvers(self, programme: str = None, k: int = 10, first: str = None, last: str = None):
+        """
+            Returns the k courses whose mean improved the most between their
+            first and last period, of the given programme if any. first and
+            last limit the periods compared (e.g. "2015/2016").
+        """
+        sql = f"SELECT c.course_tag, c.period, {self._MEAN} AS mean FROM course_periods c"
+        where, params = ["c.questions > 0"], []
+        if programme is not None:
+            sql += " JOIN programmes m ON m.course_tag = c.course_tag"
+            where.append("m.programme = ?")
+            params.append(programme)
+        if first is not None:
+            where.append("c.period >= ?")
+            params.append(first)
+        if last is not None:
+            where.append("c.period <= ?")
+            params.append(last)
+        sql += " WHERE " + " AND ".join(where) + " GROUP BY c.course_tag, c.period ORDER BY c.course_tag, c.period"
+        periods = self._query(sql, tuple(params)).dropna(subset=['mean'])
+
+        courses = periods.groupby('course_tag')
+        trends = pd.DataFrame({
+            "first_period": courses['period'].first(),
+            "first_mean": courses['mean'].first(),
+            "last_period": courses['period'].last(),
+            "last_mean": courses['mean'].last(),
+            "periods": courses.size(),
+        })
+        trends = trends[trends['periods'] > 1]
+        trends['change'] = trends['last_mean'] - trends['first_mean']
+        return trends.sort_values('change', ascending=False, kind='stable').head(k).reset_index()
+
+    def close(self):
+        with self._lock:
+            self.con.close()